@@ -0,0 +1,78 @@
+import numpy as np
+import cv2
+
+__all__ = [
+    'running_percentile',
+    'estimate_background',
+]
+
+
+def running_percentile(image, perc, size):
+    """
+    Percentile filter over a `size` window for a uint8 `image`, equivalent
+    to `scipy.ndimage.percentile_filter(image, perc, size)` with the default
+    'reflect' border mode.
+
+    The window slides along the longer side of `size` while a 256-bin
+    histogram per position across is updated with the one row entering and
+    the one row leaving the window. The percentile is read from a 16-bin
+    coarse histogram first and then from the 16 fine bins it points to, so
+    the cost per pixel does not depend on the window size.
+    """
+    s0, s1 = size
+    if s1 > s0:
+        return running_percentile(image.T, perc, (s1, s0)).T
+    n = s0 * s1
+    rank = n - 1 if perc >= 100 else int(n * perc / 100.0)
+    h, w = image.shape
+    padded = np.pad(image, ((s0 // 2, s0 - s0 // 2 - 1),
+                            (s1 // 2, s1 - s1 // 2 - 1)), mode='symmetric')
+    cols = np.arange(w, dtype=np.intp)
+    # histograms are stored bin-major, i.e. as (bins, w), so that every
+    # per-row operation below runs along contiguous memory
+    fine = np.zeros(256 * w, np.int32)
+    coarse = np.zeros(16 * w, np.int32)
+    fine_idx = [padded[:, j:j + w].astype(np.intp) * w + cols
+                for j in range(s1)]
+    coarse_idx = [(padded[:, j:j + w] >> 4).astype(np.intp) * w + cols
+                  for j in range(s1)]
+
+    def update(y, d):
+        for j in range(s1):
+            fine[fine_idx[j][y]] += d
+            coarse[coarse_idx[j][y]] += d
+
+    for y in range(s0 - 1):
+        update(y, 1)
+    out = np.empty((h, w), np.uint8)
+    cum = np.empty((16, w), np.int32)
+    fine_offs = (np.arange(16) * w)[:, None] + cols
+    for y in range(h):
+        update(y + s0 - 1, 1)
+        np.cumsum(coarse.reshape(16, w), axis=0, out=cum)
+        c = np.count_nonzero(cum <= rank, axis=0)
+        rest = rank - np.where(c > 0, cum[c - 1, cols], 0)
+        f = fine[fine_offs + c * (16 * w)]
+        np.cumsum(f, axis=0, out=f)
+        out[y] = c * 16 + np.count_nonzero(f <= rest, axis=0)
+        update(y, -1)
+    return out
+
+
+def estimate_background(image, zoom, perc, size):
+    """
+    Estimate the local whitelevel of a normalized (0..1) grayscale `image`
+    like the binarizer's spline zoom + two percentile filters, but with
+    area downsampling, uint8 sliding-histogram percentiles (see
+    `running_percentile`) and linear upsampling back to the shape of
+    `image`.
+    """
+    h, w = image.shape
+    small = cv2.resize(image.astype(np.float32),
+                       (max(1, int(round(w * zoom))), max(1, int(round(h * zoom)))),
+                       interpolation=cv2.INTER_AREA)
+    small = np.rint(np.clip(small, 0, 1) * 255).astype(np.uint8)
+    small = running_percentile(small, perc, (size, 2))
+    small = running_percentile(small, perc, (2, size))
+    return cv2.resize(small.astype(np.float32) / 255, (w, h),
+                      interpolation=cv2.INTER_LINEAR)
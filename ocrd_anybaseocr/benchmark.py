@@ -0,0 +1,526 @@
+"""
+Offline benchmark of the anyBaseOCR page methods on synthetic pages.
+
+Generates scans of pages with text-like blobs, a known skew, a ruler, a
+dark scanner border and noise, at several paper sizes and resolutions,
+runs each stage's page method on them (like a worker process would, i.e.
+without a workspace) and writes the timings, together with the accuracy
+of the skew angles and borders found, as JSON:
+
+    $ python -m ocrd_anybaseocr.benchmark -o bench.json
+    $ python -m ocrd_anybaseocr.benchmark -o new.json --compare bench.json
+
+The dewarper is benchmarked with a small stand-in generator instead of
+pix2pixHD, so its timings cover cropping, conversion and writing only.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+
+import numpy as np
+import cv2
+
+from .cache import CACHE_ENV
+from .timing import timing_enabled, enable_timing, take_timings
+
+__all__ = [
+    'PAPER_SIZES',
+    'STAGES',
+    'synthetic_page',
+    'startup_times',
+    'run_benchmark',
+    'compare_results',
+]
+
+# paper sizes in inches
+PAPER_SIZES = {
+    'a5': (5.83, 8.27),
+    'a4': (8.27, 11.69),
+    'a3': (11.69, 16.54),
+}
+
+STAGES = ['binarize', 'deskew', 'binarize-deskew', 'crop', 'dewarp']
+
+# modules whose import makes up the cold start of the command line tools
+STARTUP_MODULES = {
+    'cli': 'ocrd_anybaseocr.cli.cli',
+    'binarize': 'ocrd_anybaseocr.cli.ocrd_anybaseocr_binarize',
+    'deskew': 'ocrd_anybaseocr.cli.ocrd_anybaseocr_deskew',
+    'binarize-deskew': 'ocrd_anybaseocr.cli.ocrd_anybaseocr_binarize_deskew',
+    'crop': 'ocrd_anybaseocr.cli.ocrd_anybaseocr_cropping',
+    'dewarp': 'ocrd_anybaseocr.cli.ocrd_anybaseocr_dewarp',
+}
+
+
+def synthetic_page(paper='a4', dpi=300, skew=0.0, columns=1, ruler=True,
+                   border=True, noise=0.02, seed=0):
+    """
+    Synthetic grayscale scan (uint8) of a `paper` page at `dpi`: lines of
+    glyph-sized dark blobs in `columns` columns, rotated by `skew`
+    degrees, on a light page with a dark scanner `border` on all but the
+    right (gutter) side, like one page of a book scan, with a black and
+    white `ruler` below the page and a `noise` fraction of speckles on top
+    of Gaussian noise.
+
+    Returns the image and the ground truth: the skew angle and the
+    bounding box `(min_x, min_y, max_x, max_y)` of the text block.
+    """
+    rng = np.random.RandomState(seed)
+    inch = float(dpi)
+    pw, ph = (int(round(side * inch)) for side in PAPER_SIZES[paper])
+    # margins of the scanner bed around the page, more below for the ruler
+    if border:
+        left, top, right, bottom = (int(m * inch) for m in (0.4, 0.4, 0, 1.2))
+    else:
+        left = top = right = bottom = 0
+    width, height = pw + left + right, ph + top + bottom
+    # the scanner bed is black, which only it is
+    image = np.full((height, width), 0 if border else 235, np.uint8)
+    page = np.full((ph, pw), 235, np.uint8)
+
+    # text block with 1 inch margins, glyphs of about 10 pt
+    x0, y0, x1, y1 = int(inch), int(inch), pw - int(inch), ph - int(1.2 * inch)
+    xheight = max(2, int(0.07 * inch))
+    leading = int(0.18 * inch)
+    gutter = int(0.3 * inch)
+    colwidth = (x1 - x0 - (columns - 1) * gutter) // columns
+    for col in range(columns):
+        cx0 = x0 + col * (colwidth + gutter)
+        cx1 = cx0 + colwidth
+        for y in range(y0 + leading, y1, leading):
+            # short last lines of paragraphs
+            end = cx1 if rng.rand() > 0.1 else cx0 + int(colwidth * rng.uniform(0.3, 0.9))
+            x = cx0
+            while x < end:
+                letters = rng.randint(2, 10)
+                for _ in range(letters):
+                    glyph = max(2, int(xheight * rng.uniform(0.5, 0.9)))
+                    if x + glyph > end:
+                        break
+                    # ascenders and descenders
+                    up = xheight + (int(0.4 * xheight) if rng.rand() < 0.3 else 0)
+                    down = int(0.3 * xheight) if rng.rand() < 0.15 else 0
+                    page[y - up:y + down, x:x + glyph] = rng.randint(10, 60)
+                    x += glyph + max(1, int(0.2 * xheight))
+                x += int(xheight * rng.uniform(0.6, 1.2))
+    image[top:top + ph, left:left + pw] = page
+    textbox = np.array([[left + x0, top + y0 - xheight], [left + x1, top + y0 - xheight],
+                        [left + x1, top + y1 + xheight], [left + x0, top + y1 + xheight]],
+                       np.float64)
+
+    if ruler and border:
+        # 10 alternating dark and white fields of 0.4 inch below the page
+        rx0, ry0 = left + int(0.5 * inch), top + ph + int(0.3 * inch)
+        rh, field = int(0.5 * inch), int(0.4 * inch)
+        image[ry0:ry0 + rh, rx0:rx0 + 10 * field] = 240
+        for i in range(0, 10, 2):
+            image[ry0:ry0 + rh, rx0 + i * field:rx0 + (i + 1) * field] = 15
+
+    if skew:
+        center = (width / 2.0, height / 2.0)
+        matrix = cv2.getRotationMatrix2D(center, skew, 1.0)
+        image = cv2.warpAffine(image, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_CONSTANT,
+                               borderValue=0 if border else 235)
+        textbox = cv2.transform(textbox[None], matrix)[0]
+
+    if noise > 0:
+        # the sensor clips the noise on the scanner bed
+        bed = image == 0
+        image = image.astype(np.float32)
+        image += rng.normal(0, 6, image.shape).astype(np.float32)
+        speckles = rng.rand(height, width) < noise * 0.01
+        image[speckles] = rng.choice([0, 255], speckles.sum())
+        image = np.clip(image, 0, 255).astype(np.uint8)
+        image[bed] = 0
+
+    min_x, min_y = np.floor(textbox.min(axis=0)).astype(int)
+    max_x, max_y = np.ceil(textbox.max(axis=0)).astype(int)
+    truth = {
+        'skew': float(skew),
+        'textbox': [int(max(min_x, 0)), int(max(min_y, 0)),
+                    int(min(max_x, width - 1)), int(min(max_y, height - 1))],
+    }
+    return image, truth
+
+
+def box_iou(box1, box2):
+    """
+    Intersection over union of two `(min_x, min_y, max_x, max_y)` boxes.
+    """
+    ix = min(box1[2], box2[2]) - max(box1[0], box2[0])
+    iy = min(box1[3], box2[3]) - max(box1[1], box2[1])
+    if ix <= 0 or iy <= 0:
+        return 0.0
+    inter = float(ix) * iy
+    area1 = float(box1[2] - box1[0]) * (box1[3] - box1[1])
+    area2 = float(box2[2] - box2[0]) * (box2[3] - box2[1])
+    return inter / (area1 + area2 - inter)
+
+
+def tool_parameters(tool, parameter=None):
+    """
+    Parameters of the ocrd-tool.json `tool` with defaults filled in, run
+    sequentially and uncached, updated by `parameter`.
+    """
+    from .constants import OCRD_TOOL
+    from .utils import parse_params_with_defaults
+
+    param = parse_params_with_defaults(
+        {}, OCRD_TOOL['tools'][tool].get('parameters', {}))
+    param.update(parallel=1, cache='')
+    param.update(parameter or {})
+    return param
+
+
+def stub_dewarper(parameter):
+    """
+    Dewarper whose pix2pixHD generator is replaced by a small, randomly
+    initialized convolutional network of the same input and output.
+    """
+    import torch
+    from PIL import Image
+    from .cli.ocrd_anybaseocr_dewarp import OcrdAnybaseocrDewarper, inference_mode
+
+    class StubDewarper(OcrdAnybaseocrDewarper):
+
+        def load_model(self):
+            if self.model is None:
+                torch.manual_seed(0)
+                self.device = torch.device('cpu')
+                self.model = torch.nn.Sequential(
+                    torch.nn.Conv2d(3, 8, 3, padding=1), torch.nn.ReLU(),
+                    torch.nn.Conv2d(8, 3, 3, padding=1), torch.nn.Tanh()).eval()
+            return self.model
+
+        def dewarp_image(self, image):
+            model = self.load_model()
+            size = (self.parameter['resizeWidth'], self.parameter['resizeHeight'])
+            image = np.asarray(image.convert('RGB').resize(size, Image.BICUBIC))
+            label = torch.from_numpy(image.transpose(2, 0, 1).copy())
+            label = label.float().div(127.5).sub(1).unsqueeze(0)
+            with inference_mode():
+                generated = model(label)[0]
+            generated = (generated.numpy().transpose(1, 2, 0) + 1) * 127.5
+            return np.clip(generated, 0, 255).astype(np.uint8)
+
+    return StubDewarper(None, parameter=tool_parameters('ocrd-anybaseocr-dewarp', parameter))
+
+
+def stage_processor(stage, parameter=None):
+    """
+    Workspace-less processor of `stage` and a function running its page
+    method on a synthetic page, returning the result.
+    """
+    if stage == 'binarize':
+        from .cli.ocrd_anybaseocr_binarize import OcrdAnybaseocrBinarizer
+        processor = OcrdAnybaseocrBinarizer(None, parameter=tool_parameters(
+            'ocrd-anybaseocr-binarize', parameter))
+        return lambda fname, truth: processor.binarize_page(fname, fname)
+    if stage == 'deskew':
+        from .cli.ocrd_anybaseocr_deskew import OcrdAnybaseocrDeskewer
+        processor = OcrdAnybaseocrDeskewer(None, parameter=tool_parameters(
+            'ocrd-anybaseocr-deskew', parameter))
+        return lambda fname, truth: processor.deskew_page(fname, fname)
+    if stage == 'binarize-deskew':
+        from .cli.ocrd_anybaseocr_binarize_deskew import OcrdAnybaseocrBinarizeDeskewer
+        processor = OcrdAnybaseocrBinarizeDeskewer(None, parameter=tool_parameters(
+            'ocrd-anybaseocr-binarize-deskew', parameter))
+        return lambda fname, truth: processor.binarize_deskew_page(fname, fname)
+    if stage == 'crop':
+        from .cli.ocrd_anybaseocr_cropping import OcrdAnybaseocrCropper
+        processor = OcrdAnybaseocrCropper(None, parameter=tool_parameters(
+            'ocrd-anybaseocr-crop', parameter))
+        return lambda fname, truth: processor.crop_page(fname, fname)
+    if stage == 'dewarp':
+        processor = stub_dewarper(parameter)
+        return lambda fname, truth: processor.dewarp_page(fname, tuple(truth['textbox']))
+    raise ValueError("unknown stage '%s'" % stage)
+
+
+def skew_score_agreement(image, parameter=None):
+    """
+    Agreement of the deskewer's skew angle scores on the synthetic page
+    `image` between sheared row projections (the default) and the
+    exhaustive rotation of the page per angle, on the angles and the area
+    the deskewer searches: the largest relative deviation of the scores,
+    and by how many angle steps their best angles differ.
+    """
+    from .cli.ocrd_anybaseocr_deskew import OcrdAnybaseocrDeskewer
+    scores = {}
+    for skewscore in ('projection', 'rotate'):
+        processor = OcrdAnybaseocrDeskewer(None, parameter=tool_parameters(
+            'ocrd-anybaseocr-deskew', dict(parameter or {}, skewscore=skewscore)))
+        param = processor.parameter
+        # inverted and normalized, without the border, like in deskew_page
+        flat = 1 - image / 255.0
+        flat -= np.amin(flat)
+        flat /= np.amax(flat)
+        d0, d1 = flat.shape
+        o0, o1 = int(param['bignore']*d0), int(param['bignore']*d1)
+        ms = int(2*param['maxskew']*param['skewsteps'])
+        angles = np.linspace(-param['maxskew'], param['maxskew'], ms+1)
+        scores[skewscore] = np.array(processor.score_skew_angles(
+            flat[o0:d0-o0, o1:d1-o1], angles))
+    projection, rotate = scores['projection'], scores['rotate']
+    return {'score_deviation': float(np.amax(np.abs(projection - rotate) / rotate)),
+            'score_argmax_steps': abs(int(np.argmax(projection)) - int(np.argmax(rotate)))}
+
+
+def stage_accuracy(stage, result, truth):
+    """
+    Accuracy measures of a stage `result` against the page `truth`.
+    """
+    if result is None:
+        return {}
+    if stage in ('deskew', 'binarize-deskew'):
+        # the angle found is the rotation that corrects the skew
+        return {'angle': float(result[-1]),
+                'skew_error': abs(float(result[-1]) + truth['skew'])}
+    if stage == 'crop':
+        return {'border': [int(v) for v in result],
+                'iou': box_iou(result, truth['textbox'])}
+    return {}
+
+
+def startup_times(repeat=3):
+    """
+    Seconds to import each of `STARTUP_MODULES` in a fresh interpreter,
+    the fastest of `repeat` runs, less the start of a bare interpreter
+    (under 'python'), or the error if the import failed.
+    """
+    def run(code):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            proc = subprocess.run([sys.executable, '-c', code],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            seconds = time.perf_counter() - start
+            if proc.returncode:
+                return proc.stderr.decode(errors='replace').strip().split('\n')[-1]
+            best = seconds if best is None else min(best, seconds)
+        return best
+
+    python = run('pass')
+    times = {'python': python}
+    for name, module in sorted(STARTUP_MODULES.items()):
+        seconds = run('import %s' % module)
+        times[name] = seconds - python if isinstance(seconds, float) else seconds
+    return times
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _time_stage(stage, run, pages, workdir, repeat, stdout, parameter=None):
+    records = []
+    for name, image, truth, info in pages:
+        # each stage gets a fresh copy of the page, as it writes its
+        # results next to it
+        stagedir = os.path.join(workdir, stage)
+        if not os.path.isdir(stagedir):
+            os.makedirs(stagedir)
+        fname = os.path.join(stagedir, name + '.png')
+        cv2.imwrite(fname, image)
+        times = []
+        for _ in range(repeat):
+            with contextlib.redirect_stdout(stdout):
+                start = time.perf_counter()
+                result = run(fname, truth)
+                times.append(time.perf_counter() - start)
+        seconds = min(times)
+        spans = dict((span, histogram.total / repeat)
+                     for (span, histogram) in take_timings().items())
+        record = dict(info, page=name, skew=truth['skew'],
+                      width=image.shape[1], height=image.shape[0],
+                      seconds=seconds, median=float(np.median(times)),
+                      mpix_per_second=image.size / 1e6 / seconds,
+                      spans=spans)
+        record.update(stage_accuracy(stage, result, truth))
+        if stage == 'deskew':
+            record.update(skew_score_agreement(image, parameter))
+        records.append(record)
+        print("%-16s %-16s %8.3f s" % (stage, name, seconds), file=sys.stderr)
+        if record.get('score_argmax_steps', 0) > 1:
+            print("%-16s %-16s projection and rotation scores disagree by %d angle steps" % (
+                stage, name, record['score_argmax_steps']), file=sys.stderr)
+    return records
+
+
+def run_benchmark(papers=('a5', 'a4'), dpis=(150, 300), skews=(0.0, 1.5),
+                  stages=STAGES, repeat=3, parameter=None, workdir=None,
+                  startup=True, verbose=False):
+    """
+    Time the page method of each of `stages` on a synthetic page for each
+    combination of `papers`, `dpis` and `skews`, taking the best of
+    `repeat` runs. `parameter` maps stage names to parameter overrides.
+
+    Returns a JSON-serializable dict with the environment and, per stage,
+    one record per page (size, seconds, megapixels per second, the mean
+    seconds of each span within the page method, and any accuracy
+    measures), or the error if the stage could not be run. With `startup`,
+    the import times of the command line tools are included (see
+    `startup_times`).
+    """
+    parameter = parameter or {}
+    workdir = workdir or tempfile.mkdtemp(prefix='anybaseocr-bench-')
+    pages = []
+    for paper in papers:
+        for dpi in dpis:
+            for i, skew in enumerate(skews):
+                image, truth = synthetic_page(paper, dpi, skew, columns=1 + i % 2,
+                                              seed=len(pages))
+                name = '%s-%d-%s' % (paper, dpi, ('%+.1f' % skew).replace('.', '_'))
+                pages.append((name, image, truth, dict(paper=paper, dpi=dpi)))
+
+    results = {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'repeat': repeat,
+        'stages': {},
+    }
+    if startup:
+        results['startup'] = startup_times(repeat)
+    # the cache would turn repeated runs into lookups
+    cache_dir = os.environ.pop(CACHE_ENV, None)
+    timing = timing_enabled()
+    enable_timing()
+    take_timings()
+    quiet = open(os.devnull, 'w')
+    try:
+        for stage in stages:
+            try:
+                run = stage_processor(stage, parameter.get(stage))
+                records = _time_stage(stage, run, pages, workdir, repeat,
+                                      sys.stdout if verbose else quiet,
+                                      parameter.get(stage))
+            except Exception as err:  # missing optional dependency etc.
+                # e.g. imported lazily by the page method, on its first page
+                take_timings()
+                error = '%s: %s' % (type(err).__name__, err)
+                results['stages'][stage] = {'error': error}
+                print("%-16s skipped: %s" % (stage, error), file=sys.stderr)
+                continue
+            results['stages'][stage] = {
+                'pages': records,
+                'seconds': sum(record['seconds'] for record in records),
+            }
+    finally:
+        quiet.close()
+        enable_timing(timing)
+        if cache_dir is not None:
+            os.environ[CACHE_ENV] = cache_dir
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """
+    Per stage and page, and per startup import, the ratio of the `results`
+    time to the `baseline` time. Returns the ratios and the entries slower
+    by more than `tolerance`.
+    """
+    ratios = {}
+    slower = []
+    for name, seconds in results.get('startup', {}).items():
+        before = baseline.get('startup', {}).get(name)
+        if name != 'python' and isinstance(seconds, float) and isinstance(before, float):
+            ratios['startup/%s' % name] = seconds / before
+            if seconds / before > 1 + tolerance:
+                slower.append('startup/%s' % name)
+    for stage, current in results['stages'].items():
+        before = baseline.get('stages', {}).get(stage, {})
+        if 'pages' not in current or 'pages' not in before:
+            continue
+        previous = dict((record['page'], record['seconds']) for record in before['pages'])
+        for record in current['pages']:
+            if record['page'] in previous:
+                ratio = record['seconds'] / previous[record['page']]
+                ratios['%s/%s' % (stage, record['page'])] = ratio
+                if ratio > 1 + tolerance:
+                    slower.append('%s/%s' % (stage, record['page']))
+    return ratios, slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m ocrd_anybaseocr.benchmark', description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', help="JSON file for the results (default: stdout)")
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help="comma-separated stages (default: %(default)s)")
+    parser.add_argument('--papers', default='a5,a4',
+                        help="comma-separated paper sizes of %s (default: %%(default)s)"
+                        % ','.join(sorted(PAPER_SIZES)))
+    parser.add_argument('--dpis', default='150,300',
+                        help="comma-separated resolutions (default: %(default)s)")
+    parser.add_argument('--skews', default='0,1.5',
+                        help="comma-separated skew angles in degrees (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs per page, the fastest counts (default: %(default)s)")
+    parser.add_argument('-P', '--parameter', default='{}',
+                        help="JSON object of parameter overrides per stage, "
+                        "e.g. '{\"crop\": {\"analysisSize\": 1500}}'")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative slowdown over BASELINE that fails (default: %(default)s)")
+    parser.add_argument('--keep', metavar='DIR',
+                        help="keep the synthetic pages and outputs in DIR")
+    parser.add_argument('--no-startup', dest='startup', action='store_false',
+                        help="do not measure the import times of the tools")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="show the output of the processors")
+    args = parser.parse_args(argv)
+
+    workdir = args.keep or tempfile.mkdtemp(prefix='anybaseocr-bench-')
+    try:
+        results = run_benchmark(
+            papers=args.papers.split(','),
+            dpis=[int(dpi) for dpi in args.dpis.split(',')],
+            skews=[float(skew) for skew in args.skews.split(',')],
+            stages=args.stages.split(','), repeat=args.repeat,
+            parameter=json.loads(args.parameter), workdir=workdir,
+            startup=args.startup, verbose=args.verbose)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    slower = []
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        ratios, slower = compare_results(results, baseline, args.tolerance)
+        results['baseline'] = {'revision': baseline.get('revision'), 'ratios': ratios}
+        for page in slower:
+            print("slower than %s: %s (x%.2f)" % (args.compare, page, ratios[page]),
+                  file=sys.stderr)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 1 if slower else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+from collections import deque
+
+import numpy as np
+
+__all__ = [
+    'contour_boxes',
+    'strictly_contained',
+    'sweep_merge',
+    'merge_columns',
+]
+
+
+def contour_boxes(contours):
+    """
+    Bounding boxes `(x, y, w, h)` of all OpenCV `contours` as an (N,4)
+    array, like `cv2.boundingRect` of each, in one pass over their points.
+    """
+    if len(contours) == 0:
+        return np.zeros((0, 4), int)
+    lengths = np.array([len(c) for c in contours])
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    points = np.concatenate(contours).reshape(-1, 2)
+    x0 = np.minimum.reduceat(points[:, 0], starts)
+    y0 = np.minimum.reduceat(points[:, 1], starts)
+    x1 = np.maximum.reduceat(points[:, 0], starts)
+    y1 = np.maximum.reduceat(points[:, 1], starts)
+    return np.column_stack([x0, y0, x1-x0+1, y1-y0+1]).astype(int)
+
+
+def strictly_contained(boxes, chunk=1 << 20):
+    """
+    For an (N,4) array of `(x1, y1, x2, y2)` boxes, a boolean array telling
+    which boxes lie strictly inside (all four sides) some other box.
+
+    The boxes are swept in order of `x1`, so each box is only tested
+    against those starting left of it, in blocks of at most `chunk` pairs.
+    """
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    n = len(boxes)
+    contained = np.zeros(n, bool)
+    if n < 2:
+        return contained
+    order = np.argsort(boxes[:, 0], kind='stable')
+    sboxes = boxes[order]
+    # number of boxes starting strictly left of each box
+    left = np.searchsorted(sboxes[:, 0], sboxes[:, 0], side='left')
+    j = 0
+    while j < n:
+        k = j + 1
+        while k < n and (k + 1 - j) * left[k] <= chunk:
+            k += 1
+        m = left[k - 1]
+        if m > 0:
+            inner = sboxes[j:k, None, :]
+            outer = sboxes[None, :m, :]
+            inside = ((outer[..., 0] < inner[..., 0]) &
+                      (outer[..., 1] < inner[..., 1]) &
+                      (outer[..., 2] > inner[..., 2]) &
+                      (outer[..., 3] > inner[..., 3]))
+            contained[order[j:k]] = inside.any(axis=1)
+        j = k
+    return contained
+
+
+def sweep_merge(boxes):
+    """
+    Merge the `(x1, y1, x2, y2)` boxes, sorted by `x1` (e.g. by
+    `np.unique(..., axis=0)`), into areas of horizontally overlapping
+    boxes, the way the cropper always has:
+
+    Each round starts from the first remaining box and grows it by every
+    following box whose x range overlaps the grown box (skipping boxes
+    equal to it), in one pass. As the boxes are sorted by `x1`, that pass
+    ends at the first box starting right of the grown box, so each round
+    only touches the run of boxes it merges. The merged boxes and all
+    intermediate grown boxes (or the start box alone, if nothing was
+    merged) are then removed from the remaining ones.
+
+    Rounds stop once their count reaches the number of boxes remaining
+    at the start of the previous round. Returns the grown box of each
+    round, as tuples.
+    """
+    boxes = [tuple(int(v) for v in box) for box in boxes]
+    remaining = deque(range(len(boxes)))
+    count = len(boxes)
+    areas = []
+    i = 0
+    while i < count:
+        if not remaining:
+            break
+        count = len(remaining)
+        run = [remaining.popleft()]
+        maxBox = boxes[run[0]]
+        removed = set()
+        while remaining:
+            chkBox = boxes[remaining[0]]
+            if chkBox != maxBox:
+                x11, y11, x12, y12 = maxBox
+                x21, y21, x22, y22 = chkBox
+                if not ((x11 <= x21 <= x12) or (x21 <= x11 <= x22)):
+                    break
+                removed.add(maxBox)
+                removed.add(chkBox)
+                maxBox = (min(x11, x21), min(y11, y21),
+                          max(x12, x22), max(y12, y22))
+            run.append(remaining.popleft())
+        if not removed:
+            removed.add(maxBox)
+        remaining.extendleft(reversed(
+            [k for k in run if boxes[k] not in removed]))
+        areas.append(maxBox)
+        i += 1
+    return areas
+
+
+def merge_columns(boxes, separator):
+    """
+    Merge the `(x1, y1, x2, y2)` boxes, sorted by `x1`, whose neighbour to
+    the right starts at most `separator` after their end, into one box
+    (together with those neighbours) appended to the boxes left apart.
+    A box that is followed by a distant neighbour is left apart even if it
+    was merged with its left neighbour, as the cropper always did.
+    """
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    close = boxes[1:, 0] - boxes[:-1, 2] <= separator
+    apart = np.append(~close, not close[-1])
+    result = boxes[apart].tolist()
+    if close.any():
+        merged = np.concatenate([boxes[:-1][close], boxes[1:][close]])
+        # the merged box starts from (9999, 9999, 0, 0)
+        result.append([min(int(merged[:, 0].min()), 9999),
+                       min(int(merged[:, 1].min()), 9999),
+                       max(int(merged[:, 2].max()), 0),
+                       max(int(merged[:, 3].max()), 0)])
+    return result
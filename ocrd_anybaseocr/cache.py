@@ -0,0 +1,342 @@
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+from .parallel import map_pages, try_page, PageFailure
+from .journal import open_journal
+from .utils import print_info, print_error
+from .timing import span
+from .pipeline import submit_write, begin_page, end_page
+
+__all__ = [
+    'CACHE_ENV',
+    'CACHE_SIZE_ENV',
+    'StageCache',
+    'file_digest',
+    'file_stamp',
+    'open_cache',
+    'page_key',
+    'map_cached_pages',
+]
+
+# environment variables consulted when a processor's `cache` parameter is
+# empty: the cache directory (unset: no caching) and its size in MiB
+CACHE_ENV = 'OCRD_ANYBASEOCR_CACHE'
+CACHE_SIZE_ENV = 'OCRD_ANYBASEOCR_CACHE_SIZE'
+CACHE_SIZE_DEFAULT = 1024
+
+# parameters that do not change any result
+NEUTRAL_PARAMETERS = ('parallel', 'cache', 'prefetch', 'writeBehind', 'resume',
+                      'show', 'debug')
+
+
+def file_digest(path, chunk=1 << 20):
+    """
+    SHA-256 hex digest of the contents of the file `path`.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _json_default(value):
+    # numpy scalars
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(repr(value))
+
+
+class StageCache(object):
+    """
+    Content-addressed store of stage results in `directory`, one `.npz`
+    file of named arrays per key. Entries are replaced atomically, so
+    several processes may share a cache. Once the entries exceed
+    `max_bytes`, the least recently used ones (by modification time, which
+    a hit refreshes) are removed, down to `EVICT_TO` of `max_bytes`. `hits`
+    and `misses` count the lookups of this instance.
+    """
+
+    # fraction of `max_bytes` eviction frees the cache down to, so that the
+    # directory is only scanned again once that much has been put since
+    EVICT_TO = 0.9
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # size of the entries as of the last scan plus the puts since, as
+        # other processes sharing the cache may put and evict as well
+        self.total = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(*parts):
+        """
+        Key for the JSON-serializable `parts` (e.g. input digest, stage
+        name, version and parameters).
+        """
+        text = json.dumps(parts, sort_keys=True, default=_json_default)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def contains(self, key):
+        """
+        Whether there is an entry under `key`, without loading it or
+        counting a lookup.
+        """
+        return os.path.isfile(self.path(key))
+
+    def get(self, key):
+        """
+        The arrays stored under `key` as a dict, or None.
+        """
+        path = self.path(key)
+        try:
+            with span('cache.get'), np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def put(self, key, **arrays):
+        """
+        Store the `arrays` under `key`, then evict entries if the cache
+        has grown over the limit.
+        """
+        path = self.path(key)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with span('cache.put'), os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            size = os.path.getsize(tmp)
+            try:
+                size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        if self.total is None:
+            self.evict()
+        else:
+            self.total += size
+            if self.total > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Scan the cache directory and, if its entries exceed the limit,
+        remove the least recently used ones.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.EVICT_TO * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+        self.total = total
+
+
+def open_cache(processor):
+    """
+    The processor's cache: in the directory of its `cache` parameter if
+    set, otherwise in $OCRD_ANYBASEOCR_CACHE, or None if neither is set.
+    Its size is bounded by $OCRD_ANYBASEOCR_CACHE_SIZE MiB.
+    """
+    directory = processor.parameter.get('cache') or os.environ.get(CACHE_ENV)
+    if not directory:
+        return None
+    cache = getattr(processor, '_stage_cache', None)
+    if cache is None or cache.directory != directory:
+        size = float(os.environ.get(CACHE_SIZE_ENV) or CACHE_SIZE_DEFAULT)
+        cache = processor._stage_cache = StageCache(directory, size * 2**20)
+    return cache
+
+
+def file_stamp(path):
+    """
+    Size and modification time of the file `path`, which identify its
+    contents within a workspace without reading it (see `file_digest`).
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def page_key(processor, fname, filename, *extra):
+    """
+    Cache and journal key of a page result of `processor` for the image
+    `filename` (for `imageFilename` `fname`): its contents, the tool and
+    version, the parameters that affect results, and any `extra` inputs.
+
+    The contents are only hashed (see `file_digest`) if the processor has
+    a cache, which may be shared between workspaces. Otherwise the key
+    only serves the run's journal, and the image's `file_stamp` stands in
+    for them, so that runs without a cache do not read every input twice.
+    """
+    parameter = dict((name, value) for (name, value) in processor.parameter.items()
+                     if name not in NEUTRAL_PARAMETERS)
+    if open_cache(processor) is not None:
+        contents = file_digest(filename)
+    else:
+        contents = file_stamp(filename)
+    return StageCache.key(processor.ocrd_tool['executable'], processor.version,
+                          parameter, fname, contents, list(extra))
+
+
+def _files(result):
+    if isinstance(result, str):
+        return [result] if os.path.isfile(result) else []
+    if isinstance(result, (list, tuple)):
+        return [path for value in result for path in _files(value)]
+    return []
+
+
+def _pack(result):
+    files = _files(result)
+    arrays = dict(('file%d' % i, np.fromfile(path, np.uint8))
+                  for (i, path) in enumerate(files))
+    arrays['result'] = np.array(json.dumps(result, default=_json_default))
+    arrays['files'] = np.array(json.dumps(files))
+    return arrays
+
+
+def _unpack(arrays):
+    return json.loads(arrays['result'].item())
+
+
+def _restore(arrays):
+    # restore the files written for the result
+    for (i, path) in enumerate(json.loads(arrays['files'].item())):
+        arrays['file%d' % i].tofile(path)
+
+
+def _put(cache, key, result):
+    # best effort: the page's outputs are written, whether cached or not
+    try:
+        cache.put(key, **_pack(result))
+    except Exception as err:
+        print_error("caching a page result in %s failed: %s: %s" % (
+            cache.directory, type(err).__name__, err))
+
+
+def _finish(journal, counts, key, result, page):
+    # submitted after all writes of the page, so their outcome is known
+    if isinstance(result, PageFailure):
+        error = result.message
+    else:
+        error = page.error
+    if error is not None:
+        counts['failed'] += 1
+        if journal is not None:
+            journal.record_error(key, error)
+    elif journal is not None:
+        journal.record(key, result)
+
+
+def _report(cache, counts, total):
+    if cache is not None:
+        print_info("cache: %d hits, %d misses" % (cache.hits, cache.misses))
+    if counts['resumed']:
+        print_info("resumed: %d pages were finished before" % counts['resumed'])
+    if counts['failed']:
+        print_error("%d of %d pages failed and were skipped" % (counts['failed'], total))
+
+
+def map_cached_pages(processor, method, jobs, keys):
+    """
+    Like `map_pages`, but with the processor's cache (see `open_cache`)
+    look up each job's result under the corresponding key of `keys` (see
+    `page_key`) first, and only run the jobs that miss. Results are
+    cached together with the files they name, which are restored on hits.
+    Results come back in the order of `jobs`; tuples as lists on hits.
+    New results are stored on the write-behind queue if there is one (see
+    `write_behind`), after the writes of their files.
+
+    Every page's result, or its failure, is noted in the run's journal
+    (see `open_journal`) once all writes submitted for it are done: those
+    of the method (in the calling process), of the cache, and those the
+    caller submits before it asks for the next result (see `begin_page`).
+    With the `resume` parameter, pages an earlier run finished are not run
+    again. Pages whose method failed (see `PageFailure`) come back as
+    None; pages whose writes failed are skipped, and the run goes on.
+
+    Which pages are cached is checked and the work of the others started
+    (see `map_pages`) right away; the cached entries are only loaded one
+    page at a time as the results are consumed. Once the iterator returned
+    is exhausted, the cache hits and misses and the failed pages are
+    reported (after the pending writes), so callers must consume it to its
+    end (e.g. put it first in a `zip`).
+    """
+    cache = open_cache(processor)
+    journal = open_journal(processor)
+    jobs, keys = list(jobs), list(keys)
+    done = [journal.lookup(key) if journal is not None else (False, None)
+            for key in keys]
+    cached = [cache is not None and not finished and cache.contains(key)
+              for key, (finished, _) in zip(keys, done)]
+    results = map_pages(processor, method, [
+        job for (job, (finished, _), hit) in zip(jobs, done, cached)
+        if not finished and not hit])
+    return _map_cached(processor, method, cache, journal, jobs, keys, done,
+                       cached, results)
+
+
+def _map_cached(processor, method, cache, journal, jobs, keys, done, cached, results):
+    counts = {'resumed': 0, 'failed': 0}
+    try:
+        for job, key, (finished, result), hit in zip(jobs, keys, done, cached):
+            if finished:
+                counts['resumed'] += 1
+                yield result
+                continue
+            page = begin_page(job[0] if job else key)
+            arrays = cache.get(key) if hit else None
+            if arrays is not None:
+                result = _unpack(arrays)
+                submit_write(_restore, arrays)
+            else:
+                if hit:
+                    # evicted since it was looked up, by a put of this run
+                    # or of another process
+                    result = try_page(processor, method, job)
+                else:
+                    if cache is not None:
+                        cache.misses += 1
+                    result = next(results)
+                if cache is not None and not isinstance(result, PageFailure):
+                    submit_write(_put, cache, key, result)
+            # the caller submits its writes of the page before it asks
+            # for the next one
+            yield None if isinstance(result, PageFailure) else result
+            end_page()
+            submit_write(_finish, journal, counts, key, result, page)
+    finally:
+        end_page()
+        if journal is not None:
+            submit_write(journal.close)
+    submit_write(_report, cache, counts, len(keys))
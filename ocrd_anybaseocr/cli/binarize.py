@@ -50,7 +50,7 @@ from scipy.ndimage import filters, interpolation, morphology
 from scipy import stats
 import numpy as np
 
-from ..utils import parseXML, write_to_xml, print_info, parse_params_with_defaults, print_error
+from ..utils import iter_mets_files, write_to_xml, print_info, parse_params_with_defaults, print_error
 from ..constants import OCRD_TOOL
 
 class OcrdAnybaseocrBinarizer():
@@ -217,7 +217,7 @@ def main():
             os.mkdir(args.work)
 
     binarizer = OcrdAnybaseocrBinarizer(param)
-    files = parseXML(args.mets, args.Input)
+    files = iter_mets_files(args.mets, args.Input)
     fnames = []
     for i, fname in enumerate(files):
         fnames.append(binarizer.run(str(fname), i+1))
@@ -1,32 +1,42 @@
 import click
 
 from ocrd.decorators import ocrd_cli_options, ocrd_cli_wrap_processor
-from ocrd_anybaseocr.cli.ocrd_anybaseocr_cropping import OcrdAnybaseocrCropper
-from ocrd_anybaseocr.cli.ocrd_anybaseocr_deskew import OcrdAnybaseocrDeskewer
-from ocrd_anybaseocr.cli.ocrd_anybaseocr_binarize import OcrdAnybaseocrBinarizer
-from ocrd_anybaseocr.cli.ocrd_anybaseocr_dewarp import OcrdAnybaseocrDewarper
+
+# each command imports only its own processor (and thereby its
+# dependencies), so that e.g. cropping never loads torch
 
 
 @click.command()
 @ocrd_cli_options
 def ocrd_anybaseocr_cropping(*args, **kwargs):
+    from ocrd_anybaseocr.cli.ocrd_anybaseocr_cropping import OcrdAnybaseocrCropper
     return ocrd_cli_wrap_processor(OcrdAnybaseocrCropper, *args, **kwargs)
 
 
 @click.command()
 @ocrd_cli_options
 def ocrd_anybaseocr_deskew(*args, **kwargs):
+    from ocrd_anybaseocr.cli.ocrd_anybaseocr_deskew import OcrdAnybaseocrDeskewer
     return ocrd_cli_wrap_processor(OcrdAnybaseocrDeskewer, *args, **kwargs)
 
 
 @click.command()
 @ocrd_cli_options
 def ocrd_anybaseocr_binarize(*args, **kwargs):
+    from ocrd_anybaseocr.cli.ocrd_anybaseocr_binarize import OcrdAnybaseocrBinarizer
     return ocrd_cli_wrap_processor(OcrdAnybaseocrBinarizer, *args, **kwargs)
 
 
+@click.command()
+@ocrd_cli_options
+def ocrd_anybaseocr_binarize_deskew(*args, **kwargs):
+    from ocrd_anybaseocr.cli.ocrd_anybaseocr_binarize_deskew import OcrdAnybaseocrBinarizeDeskewer
+    return ocrd_cli_wrap_processor(OcrdAnybaseocrBinarizeDeskewer, *args, **kwargs)
+
+
 @click.command()
 # @click.option('--pix2pixhd',type=click.Path(), help="Path to pix2pixHD library.",required=True)
 @ocrd_cli_options
 def ocrd_anybaseocr_dewarp(*args, **kwargs):
+    from ocrd_anybaseocr.cli.ocrd_anybaseocr_dewarp import OcrdAnybaseocrDewarper
     return ocrd_cli_wrap_processor(OcrdAnybaseocrDewarper, *args, **kwargs)
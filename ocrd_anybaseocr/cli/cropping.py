@@ -39,7 +39,7 @@ import ocrolib
 import cv2
 from PIL import Image
 
-from ..utils import parseXML, write_to_xml, parse_params_with_defaults
+from ..utils import iter_mets_files, write_to_xml, parse_params_with_defaults
 from ..constants import OCRD_TOOL
 
 class OcrdAnybaseocrCropper():
@@ -457,7 +457,7 @@ def main():
             os.mkdir(args.work)
 
     cropper = OcrdAnybaseocrCropper(param)
-    files = parseXML(args.mets, args.Input)
+    files = iter_mets_files(args.mets, args.Input)
     fnames = []
     for i, fname in enumerate(files):
         fnames.append(cropper.run(str(fname), i+1))
@@ -52,7 +52,7 @@ from pylab import amin, amax, linspace, mean, var, plot, ginput, ones, clip, ims
 from scipy.ndimage import filters, interpolation, morphology
 from scipy import stats
 import ocrolib
-from ..utils import parseXML, write_to_xml, print_info, parse_params_with_defaults
+from ..utils import iter_mets_files, write_to_xml, print_info, parse_params_with_defaults
 from ..constants import OCRD_TOOL
 
 class OcrdAnybaseocrDeskewer():
@@ -184,7 +184,7 @@ def main():
             os.mkdir(args.work)
 
     deskewer = OcrdAnybaseocrDeskewer(param)
-    files = parseXML(args.mets, args.Input)
+    files = iter_mets_files(args.mets, args.Input)
     fnames = []
     for i, fname in enumerate(files):
         fnames.append(deskewer.run(str(fname), i+1))
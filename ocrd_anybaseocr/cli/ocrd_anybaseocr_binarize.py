@@ -38,16 +38,18 @@
 #!/usr/bin/env python
 
 
-import ocrolib
 import os
 
-from pylab import amin, amax, mean, ginput, ones, clip, imshow, median, ion, gray, minimum, array, clf
-from scipy.ndimage import filters, interpolation, morphology
-from scipy import stats
 import numpy as np
 
-from ..utils import print_info, print_error
+from ..utils import print_info, print_error, allsplitext
 from ..constants import OCRD_TOOL
+from ..cache import map_cached_pages, page_key, open_cache, file_digest
+from ..background import estimate_background
+from ..image import read_page, gray_image, write_binary_image, BILEVEL_FORMATS
+from ..threshold import StreamingHistogram, estimate_thresholds
+from ..timing import span, report_timings
+from ..pipeline import write_behind, submit_write
 
 from ocrd import Processor
 from ocrd_modelfactory import page_from_file
@@ -55,6 +57,11 @@ from ocrd_models.ocrd_page import to_xml
 from ocrd_utils import getLogger, concat_padded, MIMETYPE_PAGE
 
 
+# parameters that affect normalize_image
+NORMALIZE_PARAMETERS = ('nocheck', 'gray', 'bignore', 'escale', 'hi', 'lo',
+                        'perc', 'range', 'zoom', 'background', 'precision')
+
+
 class OcrdAnybaseocrBinarizer(Processor):
 
     def __init__(self, *args, **kwargs):
@@ -62,10 +69,17 @@ class OcrdAnybaseocrBinarizer(Processor):
         kwargs['version'] = OCRD_TOOL['version']
         super(OcrdAnybaseocrBinarizer, self).__init__(*args, **kwargs)
 
+    def page_images(self, fname, filename):
+        """
+        Images the page methods read for `filename`, as `(filename, mode)`
+        (see `prefetch_pages`).
+        """
+        return [(filename, None)]
+
     def check_page(self, image):
         if len(image.shape) == 3:
             return "input image is color image %s" % (image.shape,)
-        if mean(image) < median(image):
+        if np.mean(image) < np.median(image):
             return "image may be inverted"
         h, w = image.shape
         if h < 600:
@@ -81,123 +95,353 @@ class OcrdAnybaseocrBinarizer(Processor):
     def dshow(self, image, info):
         if self.parameter['debug'] <= 0:
             return
-        ion()
-        gray()
-        imshow(image)
-        ginput(1, self.parameter['debug'])
+        import matplotlib.pyplot as plt
+        plt.ion()
+        plt.gray()
+        plt.imshow(image)
+        plt.ginput(1, self.parameter['debug'])
 
-    def process(self):
-        for (n, input_file) in enumerate(self.input_files):
-            pcgts = page_from_file(self.workspace.download_file(input_file))
-            fname = pcgts.get_Page().imageFilename
-            img = self.workspace.resolve_image_as_pil(fname)
+    def estimate_whitelevel(self, image):
+        if self.parameter['background'] == 'histogram':
+            return estimate_background(
+                image, self.parameter['zoom'], self.parameter['perc'], self.parameter['range'])
+        from scipy.ndimage import filters, interpolation
 
-            print_info("# %s" % (fname))
-            raw = ocrolib.read_image_gray(img.filename)
+        m = interpolation.zoom(image, self.parameter['zoom'])
+        m = filters.percentile_filter(
+            m, self.parameter['perc'], size=(self.parameter['range'], 2))
+        m = filters.percentile_filter(
+            m, self.parameter['perc'], size=(2, self.parameter['range']))
+        return interpolation.zoom(m, 1.0/self.parameter['zoom'])
 
-            self.dshow(raw, "input")
+    def binarize_page(self, fname, filename):
+        """
+        Binarize the image `filename` (for `imageFilename` `fname`) and
+        write it next to it as `.bin.png` (or `.bin.tif`, see `format`).
+        Returns the path written, or
+        None if the page was skipped.
+        """
+        print_info("# %s" % (fname))
+        if self.parameter['tile'] > 0:
+            result = self.binarize_bands(fname, filename)
+        else:
+            result = self.binarize_image(fname, filename)
+        if result is None:
+            return None
+        binarized, lo, hi, comment = result
 
-            # perform image normalization
-            image = raw-amin(raw)
-            if amax(image) == amin(image):
-                print_info("# image is empty: %s" % (fname))
-                return
-            image /= amax(image)
-
-            if not self.parameter['nocheck']:
-                check = self.check_page(amax(image)-image)
-                if check is not None:
-                    print_error(fname+" SKIPPED. "+check +
-                                " (use -n to disable this check)")
-                    return
-
-            # check whether the image is already effectively binarized
-            if self.parameter['gray']:
-                extreme = 0
-            else:
-                extreme = (np.sum(image < 0.05) + np.sum(image > 0.95)
-                           ) * 1.0 / np.prod(image.shape)
-            if extreme > 0.95:
-                comment = "no-normalization"
-                flat = image
-            else:
-                comment = ""
-                # if not, we need to flatten it by estimating the local whitelevel
-                print_info("flattening")
-                m = interpolation.zoom(image, self.parameter['zoom'])
-                m = filters.percentile_filter(
-                    m, self.parameter['perc'], size=(self.parameter['range'], 2))
-                m = filters.percentile_filter(
-                    m, self.parameter['perc'], size=(2, self.parameter['range']))
-                m = interpolation.zoom(m, 1.0/self.parameter['zoom'])
-                if self.parameter['debug'] > 0:
-                    clf()
-                    imshow(m, vmin=0, vmax=1)
-                    ginput(1, self.parameter['debug'])
-                w, h = minimum(array(image.shape), array(m.shape))
-                flat = clip(image[:w, :h]-m[:w, :h]+1, 0, 1)
-                if self.parameter['debug'] > 0:
-                    clf()
-                    imshow(flat, vmin=0, vmax=1)
-                    ginput(1, self.parameter['debug'])
-
-            # estimate low and high thresholds
-            print_info("estimating thresholds")
-            d0, d1 = flat.shape
-            o0, o1 = int(self.parameter['bignore']
-                         * d0), int(self.parameter['bignore']*d1)
-            est = flat[o0:d0-o0, o1:d1-o1]
-            if self.parameter['escale'] > 0:
+        # output the normalized grayscale and the thresholded images
+        # print_info("%s lo-hi (%.2f %.2f) angle %4.1f %s" % (fname, lo, hi, angle, comment))
+        print_info("%s lo-hi (%.2f %.2f) %s" % (fname, lo, hi, comment))
+        if self.parameter['debug'] > 0 or self.parameter['show']:
+            import matplotlib.pyplot as plt
+            plt.clf()
+            plt.gray()
+            plt.imshow(binarized)
+            plt.ginput(1, max(0.1, self.parameter['debug']))
+        ext, _ = BILEVEL_FORMATS[self.parameter['format']]
+        base, _ = allsplitext(filename)
+        with span('write'):
+            write_binary_image(base + ".bin" + ext, binarized, self.parameter['compression'])
+        # ocrolib.write_image_gray(base +".nrm.png", flat)
+        # print("########### File path : ", base+".nrm.png")
+        # write_to_xml(base+".bin.png")
+        return base + ".bin" + ext
+
+    def binarize_bands(self, fname, filename):
+        """
+        Binarize the image `filename` in horizontal bands of `tile` rows,
+        so that the floating point working set is bounded by a band. Bands
+        overlap by the reach of the background filter and of the variance
+        mask, so the result only differs from `binarize_image` close to
+        band seams. The thresholds come from streaming histograms.
+
+        Memory still grows with the page, only less steeply than untiled:
+        the whole page is held as the decoded image, a 16-bit
+        flattened image, a 16-bit variance map of the area the thresholds
+        are estimated on, and the output, i.e. about 4.5 bytes per pixel
+        of an 8-bit grayscale page (16 without tiling). Returns like
+        `binarize_image`.
+        """
+        from scipy.ndimage import filters, morphology
+
+        param = self.parameter
+        raw = read_page(filename)
+        d0, d1 = raw.shape[:2]
+        zoom = param['zoom']
+        # bands start on multiples of the background decimation factor, so
+        # that the downsampled bands line up with the downsampled page
+        step = int(round(1.0/zoom))
+        if zoom >= 1 or abs(1.0/zoom - step) > 1e-6:
+            step = 1
+        tile = -(-param['tile'] // step) * step
+        bands = [(y0, min(y0 + tile, d0)) for y0 in range(0, d0, tile)]
+
+        def band(y0, y1):
+            a = raw[y0:y1]
+            if a.ndim == 3:
+                return a[:, :, :3].mean(axis=2, dtype=np.float32)
+            return a.astype(np.float32)
+
+        # perform image normalization
+        black, white = np.inf, -np.inf
+        with span('normalize'):
+            for y0, y1 in bands:
+                a = band(y0, y1)
+                black, white = min(black, np.amin(a)), max(white, np.amax(a))
+        if white == black:
+            print_info("# image is empty: %s" % (fname))
+            return None
+
+        def image(y0, y1):
+            a = band(y0, y1)
+            a -= black
+            a /= (white - black)
+            return a
+
+        # page statistics for check_page and the binarization check
+        hist = StreamingHistogram(256)
+        total = 0.0
+        extreme = 0
+        with span('check'):
+            for y0, y1 in bands:
+                a = image(y0, y1)
+                hist.add(a)
+                total += np.sum(a, dtype=np.float64)
+                extreme += np.count_nonzero(a < 0.05) + np.count_nonzero(a > 0.95)
+
+        if not param['nocheck']:
+            # like check_page on the inverted image, without the upper
+            # size limits that tiling is meant to lift
+            check = None
+            if total / (d0 * d1) > hist.percentile(50):
+                check = "image may be inverted"
+            elif d0 < 600:
+                check = "image not tall enough for a page image %s" % (raw.shape,)
+            elif d1 < 600:
+                check = "image too narrow for a page image %s" % (raw.shape,)
+            if check is not None:
+                print_error(fname+" SKIPPED. "+check +
+                            " (use -n to disable this check)")
+                return None
+
+        # check whether the image is already effectively binarized
+        if param['gray']:
+            extreme = 0
+        else:
+            extreme = extreme * 1.0 / (d0 * d1)
+        flat = np.empty((d0, d1), np.uint16)
+        if extreme > 0.95:
+            comment = "no-normalization"
+            with span('normalize'):
+                for y0, y1 in bands:
+                    flat[y0:y1] = np.rint(image(y0, y1) * 65535)
+        else:
+            comment = ""
+            # if not, we need to flatten it by estimating the local whitelevel
+            margin = int(np.ceil((param['range'] + 4) / zoom))
+            margin = -(-margin // step) * step
+            with span('flatten'):
+                for y0, y1 in bands:
+                    a0, a1 = max(0, y0 - margin), min(d0, y1 + margin)
+                    a = image(a0, a1)
+                    m = self.estimate_whitelevel(a)[:a1-a0, :d1]
+                    if m.shape != a.shape:
+                        m = np.pad(m, [(0, a.shape[0] - m.shape[0]),
+                                       (0, a.shape[1] - m.shape[1])], mode='edge')
+                    a = a[y0-a0:y1-a0]
+                    a -= m[y0-a0:y1-a0]
+                    a += 1
+                    np.clip(a, 0, 1, out=a)
+                    flat[y0:y1] = np.rint(a * 65535)
+        # free the decoded page
+        raw = None
+
+        # estimate low and high thresholds
+        o0, o1 = int(param['bignore']*d0), int(param['bignore']*d1)
+        e0, e1 = d0-o0, d1-o1
+        est_bands = [(max(y0, o0), min(y1, e0))
+                     for y0, y1 in bands if min(y1, e0) > max(y0, o0)]
+
+        def est(y0, y1):
+            return flat[y0:y1, o1:e1].astype(np.float32) / 65535
+
+        with span('thresholds'):
+            hist = StreamingHistogram()
+            if param['escale'] > 0:
                 # by default, we use only regions that contain
                 # significant variance; this makes the percentile
                 # based low and high estimates more reliable
-                e = self.parameter['escale']
-                v = est-filters.gaussian_filter(est, e*20.0)
-                v = filters.gaussian_filter(v**2, e*20.0)**0.5
-                v = (v > 0.3*amax(v))
-                v = morphology.binary_dilation(
-                    v, structure=ones((int(e*50), 1)))
-                v = morphology.binary_dilation(
-                    v, structure=ones((1, int(e*50))))
+                e = param['escale']
+                # local deviations (at most 1) are kept as 16-bit fractions
+                # until their global maximum is known
+                variance = np.empty((e0-o0, e1-o1), np.uint16)
+                margin = 2 * int(4.0 * e * 20.0 + 0.5)
+                for b0, b1 in est_bands:
+                    a0, a1 = max(o0, b0 - margin), min(e0, b1 + margin)
+                    a = est(a0, a1)
+                    v = a-filters.gaussian_filter(a, e*20.0)
+                    v = filters.gaussian_filter(v**2, e*20.0)**0.5
+                    variance[b0-o0:b1-o0] = np.rint(v[b0-a0:b1-a0] * 65535)
+                vmax = np.amax(variance)
+                margin = int(e*50)
+                for b0, b1 in est_bands:
+                    a0, a1 = max(o0, b0 - margin), min(e0, b1 + margin)
+                    v = (variance[a0-o0:a1-o0] > 0.3*vmax)
+                    v = morphology.binary_dilation(
+                        v, structure=np.ones((int(e*50), 1)))
+                    v = morphology.binary_dilation(
+                        v, structure=np.ones((1, int(e*50))))
+                    hist.add(est(b0, b1), v[b0-a0:b1-a0])
+            else:
+                for b0, b1 in est_bands:
+                    hist.add(est(b0, b1))
+            lo = hist.percentile(param['lo'])
+            hi = hist.percentile(param['hi'])
+        # rescaling to lo..hi and thresholding at `threshold` amounts to
+        # thresholding the flat image at lo + threshold*(hi-lo)
+        with span('binarize'):
+            binarized = (flat > (lo + param['threshold']*(hi-lo)) * 65535).view(np.uint8)
+        return binarized, lo, hi, comment
+
+    def binarize_image(self, fname, filename):
+        """
+        Binarize the whole image `filename` at once. Returns the
+        binarized image, the `lo` and `hi` thresholds and a comment,
+        or None if the page was skipped.
+        """
+        result = self.normalize_image(fname, filename)
+        if result is None:
+            return None
+        flat, lo, hi, comment = result
+        with span('binarize'):
+            binarized = (flat > self.parameter['threshold']).view(np.uint8)
+        return binarized, lo, hi, comment
+
+    def normalize_image(self, fname, filename):
+        """
+        Normalize, flatten and rescale the image `filename` to the
+        estimated `lo` and `hi` levels. Returns the grayscale image, `lo`,
+        `hi` and a comment, or None if the page was skipped.
+
+        With a cache (see `open_cache`), results are kept per image
+        contents and normalization parameters, so that e.g. a changed
+        `threshold` does not flatten the page again.
+        """
+        cache = open_cache(self)
+        if cache is not None:
+            key = cache.key('normalize', OCRD_TOOL['version'], file_digest(filename),
+                            dict((name, self.parameter[name]) for name in NORMALIZE_PARAMETERS))
+            arrays = cache.get(key)
+            if arrays is not None:
+                print_info("using cached normalization")
+                return (arrays['flat'], float(arrays['lo']), float(arrays['hi']),
+                        arrays['comment'].item())
+            result = self.normalize_image_uncached(fname, filename)
+            if result is not None:
+                flat, lo, hi, comment = result
+                cache.put(key, flat=flat, lo=lo, hi=hi, comment=comment)
+            return result
+        return self.normalize_image_uncached(fname, filename)
+
+    def normalize_image_uncached(self, fname, filename):
+        raw = gray_image(read_page(filename), self.parameter['precision'])
+
+        self.dshow(raw, "input")
+
+        # perform image normalization (in place, raw is not used afterwards)
+        with span('normalize'):
+            raw -= np.amin(raw)
+            image = raw
+            if np.amax(image) == np.amin(image):
+                print_info("# image is empty: %s" % (fname))
+                return None
+            image /= np.amax(image)
+
+        if not self.parameter['nocheck']:
+            with span('check'):
+                check = self.check_page(np.amax(image)-image)
+            if check is not None:
+                print_error(fname+" SKIPPED. "+check +
+                            " (use -n to disable this check)")
+                return None
+
+        # check whether the image is already effectively binarized
+        if self.parameter['gray']:
+            extreme = 0
+        else:
+            extreme = (np.sum(image < 0.05) + np.sum(image > 0.95)
+                       ) * 1.0 / np.prod(image.shape)
+        if extreme > 0.95:
+            comment = "no-normalization"
+            flat = image
+        else:
+            comment = ""
+            # if not, we need to flatten it by estimating the local whitelevel
+            with span('flatten'):
+                m = self.estimate_whitelevel(image)
                 if self.parameter['debug'] > 0:
-                    imshow(v)
-                    ginput(1, self.parameter['debug'])
-                est = est[v]
-            lo = stats.scoreatpercentile(est.ravel(), self.parameter['lo'])
-            hi = stats.scoreatpercentile(est.ravel(), self.parameter['hi'])
-            # rescale the image to get the gray scale image
-            print_info("rescaling")
+                    import matplotlib.pyplot as plt
+                    plt.clf()
+                    plt.imshow(m, vmin=0, vmax=1)
+                    plt.ginput(1, self.parameter['debug'])
+                w, h = np.minimum(np.array(image.shape), np.array(m.shape))
+                flat = image[:w, :h]
+                flat -= m[:w, :h]
+                flat += 1
+                np.clip(flat, 0, 1, out=flat)
+            if self.parameter['debug'] > 0:
+                import matplotlib.pyplot as plt
+                plt.clf()
+                plt.imshow(flat, vmin=0, vmax=1)
+                plt.ginput(1, self.parameter['debug'])
+
+        # estimate low and high thresholds
+        with span('thresholds'):
+            lo, hi = estimate_thresholds(
+                flat, self.parameter['bignore'], self.parameter['escale'],
+                self.parameter['lo'], self.parameter['hi'],
+                show=lambda v: self.dshow(v, "mask"))
+        # rescale the image to get the gray scale image
+        with span('rescale'):
             flat -= lo
             flat /= (hi-lo)
-            flat = clip(flat, 0, 1)
-            if self.parameter['debug'] > 0:
-                imshow(flat, vmin=0, vmax=1)
-                ginput(1, self.parameter['debug'])
-            binarized = 1*(flat > self.parameter['threshold'])
-
-            # output the normalized grayscale and the thresholded images
-            # print_info("%s lo-hi (%.2f %.2f) angle %4.1f %s" % (fname, lo, hi, angle, comment))
-            print_info("%s lo-hi (%.2f %.2f) %s" % (fname, lo, hi, comment))
-            print_info("writing")
-            if self.parameter['debug'] > 0 or self.parameter['show']:
-                clf()
-                gray()
-                imshow(binarized)
-                ginput(1, max(0.1, self.parameter['debug']))
-            base, _ = ocrolib.allsplitext(img.filename)
-            ocrolib.write_image_binary(base + ".bin.png", binarized)
-            # ocrolib.write_image_gray(base +".nrm.png", flat)
-            # print("########### File path : ", base+".nrm.png")
-            # write_to_xml(base+".bin.png")
-            # return base+".bin.png"
-
-            ID = concat_padded(self.output_file_grp, n)
-            self.workspace.add_file(
-                ID=ID,
-                file_grp=self.output_file_grp,
-                pageId=input_file.pageId,
-                mimetype="image/png",
-                url=base + ".bin.png",
-                local_filename='%s/%s' % (self.output_file_grp, ID),
-                content=to_xml(pcgts).encode('utf-8')
-            )
+            np.clip(flat, 0, 1, out=flat)
+        if self.parameter['debug'] > 0:
+            import matplotlib.pyplot as plt
+            plt.imshow(flat, vmin=0, vmax=1)
+            plt.ginput(1, self.parameter['debug'])
+        return flat, lo, hi, comment
+
+    def process(self):
+        pages = []
+        for (n, input_file) in enumerate(self.input_files):
+            with span('input'):
+                pcgts = page_from_file(self.workspace.download_file(input_file))
+                fname = pcgts.get_Page().imageFilename
+                filename = self.workspace.download_url(fname)
+            pages.append((n, input_file, pcgts, fname, filename))
+
+        binarized = map_cached_pages(self, 'binarize_page', [
+            (fname, filename) for (_, _, _, fname, filename) in pages], [
+            page_key(self, fname, filename) for (_, _, _, fname, filename) in pages])
+        with write_behind(self.parameter['writeBehind']):
+            for url, (n, input_file, pcgts, _, _) in zip(binarized, pages):
+                if url is None:
+                    continue
+
+                ID = concat_padded(self.output_file_grp, n)
+                with span('xml'):
+                    content = to_xml(pcgts).encode('utf-8')
+                with span('add_file'):
+                    submit_write(
+                        self.workspace.add_file,
+                        ID=ID,
+                        file_grp=self.output_file_grp,
+                        pageId=input_file.pageId,
+                        mimetype=BILEVEL_FORMATS[self.parameter['format']][1],
+                        url=url,
+                        local_filename='%s/%s' % (self.output_file_grp, ID),
+                        content=content
+                    )
+        report_timings()
@@ -0,0 +1,182 @@
+# ======================================================================
+# ====================================
+# README file for combined Binarize and Skew Correction component
+# ====================================
+
+# Filename : ocrd-anyBaseOCR-binarize-deskew.py
+
+# Author: Syed Saqib Bukhari, Mohammad Mohsin Reza, Md. Ajraf Rakib
+# Responsible: Syed Saqib Bukhari, Mohammad Mohsin Reza, Md. Ajraf Rakib
+# Contact Email: Saqib.Bukhari@dfki.de, Mohammad_mohsin.reza@dfki.de, Md_ajraf.rakib@dfki.de
+# Note:
+# 1) this work has been done in DFKI, Kaiserslautern, Germany.
+# 2) The command line IO usage is based on "OCR-D" project guidelines (https://ocr-d.github.io/).
+
+# *********** Method Behaviour ********************
+# This function takes a document image as input and produces both its
+# binarization and its skew corrected binarization, decoding and
+# normalizing the image only once.
+# *********** Method Behaviour ********************
+
+# *********** LICENSE ********************
+# License: ocropus-nlbin.py (from https://github.com/tmbdev/ocropy/) contains both functionalities: binarization and skew correction.
+# This method (ocrd-anyBaseOCR-binarize-deskew.py) combines ocrd-anyBaseOCR-binarize.py and ocrd-anyBaseOCR-deskew.py.
+# It still has the same licenses as ocropus-nlbin, i.e Apache 2.0 (the ocropy license details are pasted below).
+# This file is dependend on ocrolib library which comes from https://github.com/tmbdev/ocropy/.
+
+# Copyright 2014 Thomas M. Breuel
+
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#       http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+# limitations under the License.
+
+# *********** LICENSE ********************
+# ======================================================================
+#!/usr/bin/env python
+
+
+import numpy as np
+
+from ..utils import print_info, allsplitext
+from ..constants import OCRD_TOOL
+from ..skew import rotate_page
+from ..cache import map_cached_pages, page_key
+from ..image import write_binary_image, BILEVEL_FORMATS
+from ..timing import span, report_timings
+from ..pipeline import write_behind, submit_write
+from .ocrd_anybaseocr_binarize import OcrdAnybaseocrBinarizer
+from .ocrd_anybaseocr_deskew import OcrdAnybaseocrDeskewer
+
+from ocrd import Processor
+from ocrd_modelfactory import page_from_file
+from ocrd_models.ocrd_page import to_xml, TextRegionType
+from ocrd_utils import concat_padded
+
+
+class OcrdAnybaseocrBinarizeDeskewer(OcrdAnybaseocrBinarizer, OcrdAnybaseocrDeskewer):
+    """
+    Binarization followed by skew correction of the binarizer's flattened
+    and rescaled page, sharing the decoding, normalization and threshold
+    estimation between both. Methods come from both processors, the
+    parameters are the union of theirs.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs['ocrd_tool'] = OCRD_TOOL['tools']['ocrd-anybaseocr-binarize-deskew']
+        kwargs['version'] = OCRD_TOOL['version']
+        Processor.__init__(self, *args, **kwargs)
+
+    def binarize_deskew_page(self, fname, filename):
+        """
+        Binarize the image `filename` (for `imageFilename` `fname`) into
+        `.bin.png` next to `filename`, and its deskewed binarization into
+        `.ds.png` next to `fname` (or `.tif`, see `format`). Returns both
+        paths and the skew angle, or None if the page was skipped.
+        """
+        param = self.parameter
+        print_info("# %s" % (fname))
+        result = self.normalize_image(fname, filename)
+        if result is None:
+            return None
+        flat, lo, hi, comment = result
+        with span('binarize'):
+            binarized = (flat > param['threshold']).view(np.uint8)
+        print_info("%s lo-hi (%.2f %.2f) %s" % (fname, lo, hi, comment))
+        ext, _ = BILEVEL_FORMATS[param['format']]
+        base, _ = allsplitext(filename)
+        with span('write'):
+            write_binary_image(base + ".bin" + ext, binarized, param['compression'])
+        binarized = None
+
+        # estimate skew angle and rotate the inverted page, so that the
+        # area rotated in from outside becomes background
+        if param['maxskew'] > 0:
+            d0, d1 = flat.shape
+            o0, o1 = int(param['bignore']*d0), int(param['bignore']*d1)
+            np.subtract(1, flat, out=flat)
+            est = flat[o0:d0-o0, o1:d1-o1]
+            ma = param['maxskew']
+            ms = int(2*param['maxskew']*param['skewsteps'])
+            with span('skew'):
+                angle = self.estimate_skew_angle(est, np.linspace(-ma, ma, ms+1))
+            with span('rotate'):
+                flat = rotate_page(flat, angle, param['rotateorder'],
+                                   param['rotatetolerance'])
+            with span('binarize'):
+                deskewed = (flat < 1 - param['threshold']).view(np.uint8)
+        else:
+            angle = 0
+            with span('binarize'):
+                deskewed = (flat > param['threshold']).view(np.uint8)
+        print_info("%s angle %4.1f" % (fname, angle))
+        ds_base, _ = allsplitext(fname)
+        with span('write'):
+            write_binary_image(ds_base + ".ds" + ext, deskewed, param['compression'])
+        return base + ".bin" + ext, ds_base + ".ds" + ext, angle
+
+    def process(self):
+        # with two output file groups, the binarized images go to the
+        # first and the deskewed ones to the second, otherwise only the
+        # deskewed images are added
+        output_file_grps = self.output_file_grp.split(',')
+        bin_grp, ds_grp = output_file_grps[0], output_file_grps[-1]
+
+        pages = []
+        for (n, input_file) in enumerate(self.input_files):
+            with span('input'):
+                pcgts = page_from_file(self.workspace.download_file(input_file))
+                fname = pcgts.get_Page().imageFilename
+                filename = self.workspace.download_url(fname)
+            pages.append((n, input_file, pcgts, fname, filename))
+
+        results = map_cached_pages(self, 'binarize_deskew_page', [
+            (fname, filename) for (_, _, _, fname, filename) in pages], [
+            page_key(self, fname, filename) for (_, _, _, fname, filename) in pages])
+        with write_behind(self.parameter['writeBehind']):
+            for result, (n, input_file, pcgts, _, _) in zip(results, pages):
+                if result is None:
+                    continue
+                bin_url, ds_url, angle = result
+
+                if len(output_file_grps) > 1:
+                    ID = concat_padded(bin_grp, n)
+                    with span('xml'):
+                        content = to_xml(pcgts).encode('utf-8')
+                    with span('add_file'):
+                        submit_write(
+                            self.workspace.add_file,
+                            ID=ID,
+                            file_grp=bin_grp,
+                            pageId=input_file.pageId,
+                            mimetype=BILEVEL_FORMATS[self.parameter['format']][1],
+                            url=bin_url,
+                            local_filename='%s/%s' % (bin_grp, ID),
+                            content=content
+                        )
+
+                orientation = TextRegionType(orientation=angle)
+                pcgts.get_Page().add_TextRegion(orientation)
+
+                ID = concat_padded(ds_grp, n)
+                with span('xml'):
+                    content = to_xml(pcgts).encode('utf-8')
+                with span('add_file'):
+                    submit_write(
+                        self.workspace.add_file,
+                        ID=ID,
+                        file_grp=ds_grp,
+                        pageId=input_file.pageId,
+                        mimetype=BILEVEL_FORMATS[self.parameter['format']][1],
+                        url=ds_url,
+                        local_filename='%s/%s' % (ds_grp, ID),
+                        content=content
+                    )
+        report_timings()
@@ -31,13 +31,16 @@
 
 
 import numpy as np
-from pylsd.lsd import lsd
-import ocrolib
 import cv2
 from PIL import Image
 
 
 from ..constants import OCRD_TOOL
+from ..cache import map_cached_pages, page_key
+from ..boxes import contour_boxes, strictly_contained, sweep_merge, merge_columns
+from ..image import read_page
+from ..timing import span, report_timings
+from ..pipeline import write_behind, submit_write
 
 from ocrd import Processor
 from ocrd_utils import getLogger, concat_padded, MIMETYPE_PAGE
@@ -55,6 +58,23 @@ class OcrdAnybaseocrCropper(Processor):
         kwargs['ocrd_tool'] = OCRD_TOOL['tools']['ocrd-anybaseocr-crop']
         kwargs['version'] = OCRD_TOOL['version']
         super(OcrdAnybaseocrCropper, self).__init__(*args, **kwargs)
+        # scale of the analysed image relative to the page, for the
+        # distances below which are given in pixels at full resolution
+        self.pixelScale = 1.0
+
+    def page_images(self, fname, filename):
+        """
+        Images the page methods read for `filename`, as `(filename, mode)`
+        (see `prefetch_pages`).
+        """
+        return [(filename, 'L')]
+
+    def pixels(self, distance):
+        """
+        `distance` in pixels at full resolution, in pixels of the analysed
+        image (rounded).
+        """
+        return int(round(distance*self.pixelScale))
 
     def write_crop_coordinate(self, base, coordinate):
         x1, y1, x2, y2 = coordinate
@@ -72,120 +92,156 @@ class OcrdAnybaseocrCropper(Processor):
         imgArea = height*width
 
         # Get bounding box x,y,w,h of each contours
-        rects = [cv2.boundingRect(cnt) for cnt in contours]
-        rects = sorted(rects, key=lambda x: (x[2]*x[3]), reverse=True)
+        rects = np.array([cv2.boundingRect(cnt) for cnt in contours],
+                         dtype=int).reshape(-1, 4)
+        area = rects[:, 2]*rects[:, 3]
+        order = np.argsort(-area, kind='stable')
+        rects, area = rects[order], area[order]
         # consider those rectangle whose area>10000 and less than one-fourth of images
-        rects = [r for r in rects if (
-            imgArea*self.parameter['maxRularArea']) > (r[2]*r[3]) > (imgArea*self.parameter['minRularArea'])]
+        rects = rects[((imgArea*self.parameter['maxRularArea']) > area) &
+                      (area > (imgArea*self.parameter['minRularArea']))]
 
-        # detect child rectangles. Usually those are not ruler. Rular position are basically any one side.
-        removeRect = []
-        for i, rect1 in enumerate(rects):
-            (x1, y1, w1, h1) = rect1
-            for rect2 in rects[i+1:len(rects)]:
-                (x2, y2, w2, h2) = rect2
-                if (x1 < x2) and (y1 < y2) and (x1+w1 > x2+w2) and (y1+h1 > y2+h2):
-                    removeRect.append(rect2)
+        # detect and remove child rectangles. Usually those are not ruler. Rular position are basically any one side.
+        x, y, w, h = rects.T
+        rects = rects[~strictly_contained(np.column_stack([x, y, x+w, y+h]))]
 
-        # removed child rectangles.
-        rects = [x for x in rects if x not in removeRect]
+        x, y, w, h = rects.T
+        candidates = rects[(w < width*self.parameter['rularWidth']) & (
+            (y > height*self.parameter['positionBelow']) |
+            ((x+w) < width*self.parameter['positionLeft']) |
+            (x > width*self.parameter['positionRight']))]
 
         predictRular = []
-        for rect in rects:
-            (x, y, w, h) = rect
-            if (w < width*self.parameter['rularWidth']) and ((y > height*self.parameter['positionBelow']) or ((x+w) < width*self.parameter['positionLeft']) or (x > width*self.parameter['positionRight'])):
-                if (self.parameter['rularRatioMin'] < round(float(w)/float(h), 2) < self.parameter['rularRatioMax']) or (self.parameter['rularRatioMin'] < round(float(h)/float(w), 2) < self.parameter['rularRatioMax']):
-                    blackPixel = np.count_nonzero(arg[y:y+h, x:x+w] == 0)
-                    predictRular.append((x, y, w, h, blackPixel))
+        for (x, y, w, h) in candidates.tolist():
+            if (self.parameter['rularRatioMin'] < round(float(w)/float(h), 2) < self.parameter['rularRatioMax']) or (self.parameter['rularRatioMin'] < round(float(h)/float(w), 2) < self.parameter['rularRatioMax']):
+                blackPixel = np.count_nonzero(arg[y:y+h, x:x+w] == 0)
+                predictRular.append((x, y, w, h, blackPixel))
 
         # Finally check number of black pixel to avoid false rular
         if predictRular:
             predictRular = sorted(
                 predictRular, key=lambda x: (x[4]), reverse=True)
             x, y, w, h, _ = predictRular[0]
-            cv2.rectangle(arg, (x-15, y-15), (x+w+20, y+h+20),
+            cv2.rectangle(arg, (x-self.pixels(15), y-self.pixels(15)),
+                          (x+w+self.pixels(20), y+h+self.pixels(20)),
                           (255, 255, 255), cv2.FILLED)
         return arg
 
     def BorderLine(self, MaxBoundary, lines, index, flag, lineDetectH, lineDetectV):
-        getLine = 1
-        LastLine = []
+        """
+        Find the first run of at least 3 `lines` (sorted by coordinate
+        `index`) less than 15 pixels apart on the `flag` side of
+        `MaxBoundary`, scanning from the top/left or bottom/right, and add
+        the innermost line of that run to `lineDetectH` or `lineDetectV`.
+        """
+        lines = np.asarray(lines).reshape(-1, 4)
+        coord = lines[:, index]
+        close = abs(coord[:-1]-coord[1:]) <= 15*self.pixelScale
         if flag in ('top', 'left'):
-            for i in range(len(lines)-1):
-                if(abs(lines[i][index]-lines[i+1][index])) <= 15 and lines[i][index] < MaxBoundary:
-                    LastLine = [lines[i][0], lines[i]
-                                [1], lines[i][2], lines[i][3]]
-                    getLine += 1
-                elif getLine >= 3:
-                    break
-                else:
-                    getLine = 1
+            close &= coord[:-1] < MaxBoundary
+            order = np.arange(len(close))
         elif flag in ('bottom', 'right'):
-            for i in reversed(list(range(len(lines)-1))):
-                if(abs(lines[i][index]-lines[i+1][index])) <= 15 and lines[i][index] > MaxBoundary:
-                    LastLine = [lines[i][0], lines[i]
-                                [1], lines[i][2], lines[i][3]]
-                    getLine += 1
-                elif getLine >= 3:
-                    break
-                else:
-                    getLine = 1
-        if getLine >= 3 and LastLine:
-            if flag == "top":
-                lineDetectH.append((
-                    LastLine[0], max(LastLine[1], LastLine[3]),
-                    LastLine[2], max(LastLine[1], LastLine[3])
-                ))
-            if flag == "left":
-                lineDetectV.append((
-                    max(LastLine[0], LastLine[2]), LastLine[1],
-                    max(LastLine[0], LastLine[2]), LastLine[3]
-                ))
-            if flag == "bottom":
-                lineDetectH.append((
-                    LastLine[0], min(LastLine[1], LastLine[3]),
-                    LastLine[2], min(LastLine[1], LastLine[3])
-                ))
-            if flag == "right":
-                lineDetectV.append((
-                    min(LastLine[0], LastLine[2]), LastLine[1],
-                    min(LastLine[0], LastLine[2]), LastLine[3]
-                ))
-
-    def get_intersect(self, a1, a2, b1, b2):
-        s = np.vstack([a1, a2, b1, b2])        # s for stacked
-        h = np.hstack((s, np.ones((4, 1))))  # h for homogeneous
-        l1 = np.cross(h[0], h[1])           # get first line
-        l2 = np.cross(h[2], h[3])           # get second line
-        x, y, z = np.cross(l1, l2)
-        if z == 0:
-            # return (float('inf'), float('inf'))
-            return (0, 0)
-        return (x/z, y/z)
+            close &= coord[:-1] > MaxBoundary
+            order = np.arange(len(close))[::-1]
+        # runs of consecutive close pairs, in scanning order
+        edges = np.flatnonzero(np.diff(np.concatenate(
+            [[False], close[order], [False]]).view(np.int8)))
+        starts, ends = edges[::2], edges[1::2]
+        runs = np.flatnonzero(ends-starts >= 2)
+        if len(runs) == 0:
+            return
+        LastLine = lines[order[ends[runs[0]]-1]].tolist()
+        if flag == "top":
+            lineDetectH.append((
+                LastLine[0], max(LastLine[1], LastLine[3]),
+                LastLine[2], max(LastLine[1], LastLine[3])
+            ))
+        if flag == "left":
+            lineDetectV.append((
+                max(LastLine[0], LastLine[2]), LastLine[1],
+                max(LastLine[0], LastLine[2]), LastLine[3]
+            ))
+        if flag == "bottom":
+            lineDetectH.append((
+                LastLine[0], min(LastLine[1], LastLine[3]),
+                LastLine[2], min(LastLine[1], LastLine[3])
+            ))
+        if flag == "right":
+            lineDetectV.append((
+                min(LastLine[0], LastLine[2]), LastLine[1],
+                min(LastLine[0], LastLine[2]), LastLine[3]
+            ))
+
+    def get_intersects(self, lines1, lines2):
+        """
+        Intersection points (x, y) of all pairs of the (N,4) `lines1` and
+        (M,4) `lines2`, each line given by two points, as an (N,M,2) array.
+        Parallel lines intersect at (0, 0).
+        """
+        def homogeneous(lines):
+            points = np.asarray(lines, dtype=float).reshape(-1, 2, 2)
+            points = np.concatenate(
+                [points, np.ones(points.shape[:2] + (1,))], axis=2)
+            return np.cross(points[:, 0], points[:, 1])
+        l1 = homogeneous(lines1)[:, None, :]
+        l2 = homogeneous(lines2)[None, :, :]
+        x, y, z = np.moveaxis(np.cross(l1, l2), -1, 0)
+        parallel = z == 0
+        z = np.where(parallel, 1, z)
+        return np.where(parallel[..., None], 0, np.stack([x/z, y/z], axis=-1))
+
+    def band_lines(self, arg, rows, cols):
+        """
+        LSD segments `(x1, y1, x2, y2)` of the region `rows`, `cols` (slices)
+        of `arg`, detected at `lineScale` resolution and mapped back to
+        page coordinates.
+        """
+        from pylsd.lsd import lsd
+
+        scale = self.parameter['lineScale']
+        band = arg[rows, cols]
+        if scale < 1:
+            band = cv2.resize(band, (max(1, int(round(band.shape[1]*scale))),
+                                     max(1, int(round(band.shape[0]*scale)))),
+                              interpolation=cv2.INTER_AREA)
+        lines = np.asarray(lsd(np.ascontiguousarray(band)))
+        lines = lines.reshape(-1, lines.shape[-1] if lines.size else 5)[:, :4]
+        if scale < 1:
+            lines = lines / scale
+        return lines + [cols.start, rows.start, cols.start, rows.start]
 
     def detect_lines(self, arg):
-        Hline = []
-        Vline = []
         # gray = cv2.cvtColor(arg, cv2.COLOR_RGB2GRAY)
         imgHeight, imgWidth = arg.shape
-        lines = lsd(arg)
-
-        for i in range(lines.shape[0]):
-            pt1 = (int(lines[i, 0]), int(lines[i, 1]))
-            pt2 = (int(lines[i, 2]), int(lines[i, 3]))
-            # consider those line whise length more than this orbitrary value
-            if (abs(pt1[0]-pt2[0]) > 45) and ((int(pt1[1]) < imgHeight*0.25) or (int(pt1[1]) > imgHeight*0.75)):
-                # make full horizontal line
-                Hline.append([0, int(pt1[1]), imgWidth, int(pt2[1])])
-            if (abs(pt1[1]-pt2[1]) > 45) and ((int(pt1[0]) < imgWidth*0.4) or (int(pt1[0]) > imgWidth*0.6)):
-                # make full vertical line
-                Vline.append([int(pt1[0]), 0, int(pt2[0]), imgHeight])
-        Hline.sort(key=lambda x: (x[1]), reverse=False)
-        Vline.sort(key=lambda x: (x[0]), reverse=False)
+        # horizontal lines can only come from the top and bottom quarter,
+        # vertical ones from the left and right 40% (with some margin)
+        top, bottom = int(imgHeight*0.25) + 8, int(imgHeight*0.75) - 8
+        left, right = int(imgWidth*0.4) + 8, int(imgWidth*0.6) - 8
+        full = slice(0, None)
+        hlines = np.concatenate([
+            self.band_lines(arg, slice(0, top), full),
+            self.band_lines(arg, slice(bottom, imgHeight), full)])
+        vlines = np.concatenate([
+            self.band_lines(arg, full, slice(0, left)),
+            self.band_lines(arg, full, slice(right, imgWidth))])
+
+        # consider those line whise length more than this orbitrary value
+        # and make them full horizontal/vertical lines
+        x1, y1, x2, y2 = hlines.astype(int).T
+        h = (abs(x1-x2) > 45*self.pixelScale) & ((y1 < imgHeight*0.25) | (y1 > imgHeight*0.75))
+        Hline = np.column_stack([
+            np.zeros(h.sum(), int), y1[h], np.full(h.sum(), imgWidth), y2[h]])
+        x1, y1, x2, y2 = vlines.astype(int).T
+        v = (abs(y1-y2) > 45*self.pixelScale) & ((x1 < imgWidth*0.4) | (x1 > imgWidth*0.6))
+        Vline = np.column_stack([
+            x1[v], np.zeros(v.sum(), int), x2[v], np.full(v.sum(), imgHeight)])
+        Hline = Hline[np.argsort(Hline[:, 1], kind='stable')]
+        Vline = Vline[np.argsort(Vline[:, 0], kind='stable')]
         return imgHeight, imgWidth, Hline, Vline
 
     def select_borderLine(self, arg, lineDetectH, lineDetectV):
-        imgHeight, imgWidth, Hlines, Vlines = self.detect_lines(arg)
+        with span('lines'):
+            imgHeight, imgWidth, Hlines, Vlines = self.detect_lines(arg)
 
         # top side
         self.BorderLine(imgHeight*0.25, Hlines, 1,
@@ -200,72 +256,80 @@ class OcrdAnybaseocrCropper(Processor):
         self.BorderLine(imgWidth*0.6, Vlines, 0, "right",
                         lineDetectH, lineDetectV)
 
-        intersectPoint = []
-        for l1 in lineDetectH:
-            for l2 in lineDetectV:
-                x, y = self.get_intersect(
-                    (l1[0], l1[1]),
-                    (l1[2], l1[3]),
-                    (l2[0], l2[1]),
-                    (l2[2], l2[3])
-                )
-                intersectPoint.append([x, y])
+        d10, d15 = self.pixels(10), self.pixels(15)
         Xstart = 0
         Xend = imgWidth
         Ystart = 0
         Yend = imgHeight
-        for i in intersectPoint:
-            Xs = int(i[0])+10 if i[0] < imgWidth*0.4 else 10
-            if Xs > Xstart:
-                Xstart = Xs
-            Xe = int(i[0])-10 if i[0] > imgWidth*0.6 else int(imgWidth)-10
-            if Xe < Xend:
-                Xend = Xe
-            Ys = int(i[1])+10 if i[1] < imgHeight*0.25 else 10
-            # print("Ys,Ystart:",Ys,Ystart)
-            if Ys > Ystart:
-                Ystart = Ys
-            Ye = int(i[1])-15 if i[1] > imgHeight*0.75 else int(imgHeight)-15
-            if Ye < Yend:
-                Yend = Ye
+        if lineDetectH and lineDetectV:
+            x, y = self.get_intersects(
+                lineDetectH, lineDetectV).reshape(-1, 2).T
+            ix, iy = np.trunc(x).astype(int), np.trunc(y).astype(int)
+            Xstart = max(Xstart, int(np.where(
+                x < imgWidth*0.4, ix+d10, d10).max()))
+            Xend = min(Xend, int(np.where(
+                x > imgWidth*0.6, ix-d10, int(imgWidth)-d10).min()))
+            Ystart = max(Ystart, int(np.where(
+                y < imgHeight*0.25, iy+d10, d10).max()))
+            Yend = min(Yend, int(np.where(
+                y > imgHeight*0.75, iy-d15, int(imgHeight)-d15).min()))
 
         if Xend < 0:
-            Xend = 10
+            Xend = d10
         if Yend < 0:
-            Yend = 15
+            Yend = d15
         #self.save_pf(base, [Xstart, Ystart, Xend, Yend])
 
         return [Xstart, Ystart, Xend, Yend]
 
     def filter_noisebox(self, textarea, height, width):
-        tmp = []
-        st = True
-
-        while st:
-            textarea = [list(x) for x in textarea if x not in tmp]
-            if len(textarea) > 1:
-                tmp = []
-                textarea = sorted(
-                    textarea, key=lambda x: (x[3]), reverse=False)
-                # print textarea
-                x11, y11, x12, y12 = textarea[0]
-                x21, y21, x22, y22 = textarea[1]
-
-                if abs(y12-y21) > 100 and (float(abs(x12-x11)*abs(y12-y11))/(height*width)) < 0.001:
-                    tmp.append(textarea[0])
-
-                x11, y11, x12, y12 = textarea[-2]
-                x21, y21, x22, y22 = textarea[-1]
-
-                if abs(y12-y21) > 100 and (float(abs(x21-x22)*abs(y22-y21))/(height*width)) < 0.001:
-                    tmp.append(textarea[-1])
-
-                if len(tmp) == 0:
-                    st = False
-            else:
+        """
+        Repeatedly drop the topmost/bottommost (by lower edge) box if it is
+        tiny and more than 100 pixels away from its neighbour, together
+        with any identical boxes.
+        """
+        boxes = np.asarray(textarea).reshape(-1, 4)
+        boxes = boxes[np.argsort(boxes[:, 3], kind='stable')]
+        _, group = np.unique(boxes, axis=0, return_inverse=True)
+        group = group.ravel()
+        members = np.split(np.argsort(group, kind='stable'),
+                           np.cumsum(np.bincount(group))[:-1])
+        alive = np.ones(len(boxes), bool)
+        remaining = len(boxes)
+        first, last = 0, len(boxes) - 1
+
+        def next_alive(i, step):
+            i += step
+            while not alive[i]:
+                i += step
+            return i
+
+        while remaining > 1:
+            while not alive[first]:
+                first += 1
+            while not alive[last]:
+                last -= 1
+            tmp = []
+
+            x11, y11, x12, y12 = boxes[first].tolist()
+            x21, y21, x22, y22 = boxes[next_alive(first, 1)].tolist()
+
+            if abs(y12-y21) > 100*self.pixelScale and (float(abs(x12-x11)*abs(y12-y11))/(height*width)) < 0.001:
+                tmp.append(group[first])
+
+            x11, y11, x12, y12 = boxes[next_alive(last, -1)].tolist()
+            x21, y21, x22, y22 = boxes[last].tolist()
+
+            if abs(y12-y21) > 100*self.pixelScale and (float(abs(x21-x22)*abs(y22-y21))/(height*width)) < 0.001:
+                tmp.append(group[last])
+
+            if len(tmp) == 0:
                 break
+            for g in set(tmp):
+                alive[members[g]] = False
+                remaining -= len(members[g])
 
-        return textarea
+        return boxes[alive].tolist()
 
     def detect_textarea(self, arg):
         textarea = []
@@ -279,21 +343,34 @@ class OcrdAnybaseocrCropper(Processor):
             grad, 0.0, 255.0, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
 
         kernel = cv2.getStructuringElement(
-            cv2.MORPH_RECT, (10, 1))  # for historical docs
+            cv2.MORPH_RECT, (max(1, self.pixels(10)), 1))  # for historical docs
         connected = cv2.morphologyEx(bw, cv2.MORPH_CLOSE, kernel)
         contours, _ = cv2.findContours(
             connected.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
 
-        mask = np.zeros(bw.shape, dtype=np.uint8)
-
-        for idx in range(len(contours)):
-            x, y, w, h = cv2.boundingRect(contours[idx])
-            # print x,y,w,h
-            mask[y:y+h, x:x+w] = 0
-            cv2.drawContours(mask, contours, idx, (255, 255, 255), -1)
-            r = float(cv2.countNonZero(mask[y:y+h, x:x+w])) / (w * h)
-
-            if r > 0.45 and (width*0.9) > w > 15 and (height*0.5) > h > 15:
+        # only contours of text block size need their fill ratio; external
+        # contours do not overlap when filled, so all of them are filled at
+        # once and each one's area is that of its connected component
+        rects = contour_boxes(contours)
+        x, y, w, h = rects.T
+        candidates = np.flatnonzero(
+            ((width*0.9) > w) & (w > 15*self.pixelScale) &
+            ((height*0.5) > h) & (h > 15*self.pixelScale))
+        if len(candidates):
+            mask = np.zeros((height, width), dtype=np.uint8)
+            cv2.drawContours(mask, [contours[idx] for idx in candidates], -1,
+                             255, -1)
+            _, labels, stats, _ = cv2.connectedComponentsWithStats(
+                mask, connectivity=8)
+            points = np.array([contours[idx][0, 0] for idx in candidates])
+            areas = stats[labels[points[:, 1], points[:, 0]], cv2.CC_STAT_AREA]
+            ratios = areas / (w[candidates] * h[candidates]).astype(float)
+        else:
+            ratios = []
+
+        for idx, r in zip(candidates.tolist(), ratios):
+            x, y, w, h = rects[idx].tolist()
+            if r > 0.45:
                 textarea.append([x, y, x+w-1, y+h-1])
                 cv2.rectangle(arg, (x, y), (x+w-1, y+h-1), (0, 0, 255), 2)
 
@@ -312,69 +389,21 @@ class OcrdAnybaseocrCropper(Processor):
 
     def filter_area(self, textarea, binImg):
         height, width = binImg.shape
-        tmp = []
-        for area in textarea:
-            if (height*width*self.parameter['minArea'] < (abs(area[2]-area[0]) * abs(area[3]-area[1]))):
-                tmp.append(area)
-        return tmp
+        textarea = np.asarray(textarea).reshape(-1, 4)
+        area = abs(textarea[:, 2]-textarea[:, 0]) * \
+            abs(textarea[:, 3]-textarea[:, 1])
+        return textarea[height*width*self.parameter['minArea'] < area].tolist()
 
     def marge_columns(self, textarea):
-        tmp = []
-        marge = []
-        #  height, _ = binImg.shape
-        # print binImg.shape
-        textarea.sort(key=lambda x: (x[0]))
-        # print self.parameter['colSeparator']
-        for i in range(len(textarea)-1):
-            st = False
-            x11, y11, x12, y12 = textarea[i]
-            x21, y21, x22, y22 = textarea[i+1]
-            if x21-x12 <= self.parameter['colSeparator']:
-                if len(marge) > 0:
-                    # print "marge ", marge[0]
-                    x31, y31, x32, y32 = marge[0]
-                    marge.pop(0)
-                else:
-                    x31, y31, x32, y32 = [9999, 9999, 0, 0]
-                marge.append([min(x11, x21, x31), min(y11, y21, y31),
-                              max(x12, x22, x32), max(y12, y22, y32)])
-                st = True
-            else:
-                tmp.append(textarea[i])
-
-        if not st:
-            tmp.append(textarea[-1])
-
-        return tmp+marge
+        textarea = sorted(textarea, key=lambda x: (x[0]))
+        return merge_columns(textarea, self.colSeparator)
 
     def crop_area(self, textarea, binImg, rgb):
         height, width = binImg.shape
 
-        textarea = np.unique(textarea, axis=0)
-        i = 0
-        tmp = []
-        areas = []
-        while i < len(textarea):
-            textarea = [list(x) for x in textarea if x not in tmp]
-            tmp = []
-            if len(textarea) == 0:
-                break
-            maxBox = textarea[0]
-            for chkBox in textarea:
-                if maxBox != chkBox:
-                    x11, y11, x12, y12 = maxBox
-                    x21, y21, x22, y22 = chkBox
-                    if ((x11 <= x21 <= x12) or (x21 <= x11 <= x22)):
-                        tmp.append(maxBox)
-                        tmp.append(chkBox)
-                        maxBox = [min(x11, x21), min(y11, y21),
-                                  max(x12, x22), max(y12, y22)]
-            if len(tmp) == 0:
-                tmp.append(maxBox)
-            x1, y1, x2, y2 = maxBox
-            areas.append(maxBox)
+        areas = sweep_merge(np.unique(textarea, axis=0))
+        for (x1, y1, x2, y2) in areas:
             cv2.rectangle(rgb, (x1, y1), (x2, y2), (255, 0, 0), 2)
-            i = i+1
 
         textarea = np.unique(areas, axis=0).tolist()
         if len(textarea) > 0:
@@ -397,61 +426,160 @@ class OcrdAnybaseocrCropper(Processor):
 
         return textarea
 
-    def process(self):
-        for (n, input_file) in enumerate(self.input_files):
-            pcgts = page_from_file(self.workspace.download_file(input_file))
-            fname = pcgts.get_Page().imageFilename
-            img = self.workspace.resolve_image_as_pil(fname)
-            #fname = str(fname)
-            print("Process file: ", fname)
-            base, _ = ocrolib.allsplitext(fname)
-
-            img_array = ocrolib.pil2array(img)
-            img_array_bin = np.array(
-                img_array > ocrolib.midrange(img_array), 'i')
-
-            lineDetectH = []
-            lineDetectV = []
+    def detect_border(self, img_array):
+        """
+        Detect the page content area of the grayscale `img_array`. Returns
+        its bounding box `(min_x, min_y, max_x, max_y)` and whether it was
+        derived from text areas (rather than from border lines).
+        """
+        import ocrolib
+
+        img_array_bin = np.array(
+            img_array > ocrolib.midrange(img_array), 'i')
+
+        lineDetectH = []
+        lineDetectV = []
+        with span('remove_rular'):
             img_array_rr = self.remove_rular(img_array)
 
+        with span('textarea'):
             textarea, img_array_rr_ta, height, width = self.detect_textarea(
                 img_array_rr)
-            self.parameter['colSeparator'] = int(
-                width * self.parameter['colSeparator'])
+        self.colSeparator = int(width * self.parameter['colSeparator'])
 
-            if len(textarea) > 1:
+        if len(textarea) > 1:
+            with span('crop_area'):
                 textarea = self.crop_area(
                     textarea, img_array_bin, img_array_rr_ta)
 
-                if len(textarea) == 0:
-                    min_x, min_y, max_x, max_y = self.select_borderLine(
-                        img_array_rr, lineDetectH, lineDetectV)
-                else:
-                    min_x, min_y, max_x, max_y = textarea[0]
-            elif len(textarea) == 1 and (height*width*0.5 < (abs(textarea[0][2]-textarea[0][0]) * abs(textarea[0][3]-textarea[0][1]))):
-                x1, y1, x2, y2 = textarea[0]
-                x1 = x1-20 if x1 > 20 else 0
-                x2 = x2+20 if x2 < width-20 else width
-                y1 = y1-40 if y1 > 40 else 0
-                y2 = y2+40 if y2 < height-40 else height
-
-                #self.save_pf(base, [x1, y1, x2, y2])
-                min_x, min_y, max_x, max_y = textarea[0]
-            else:
-                min_x, min_y, max_x, max_y = self.select_borderLine(
-                    img_array_rr, lineDetectH, lineDetectV)
-
-            brd = BorderType(Coords=CoordsType("%i,%i %i,%i %i,%i %i,%i" % (
-                min_x, min_y, max_x, min_y, max_x, max_y, min_x, max_y)))
-            pcgts.get_Page().set_Border(brd)
-
-            ID = concat_padded(self.output_file_grp, n)
-            self.workspace.add_file(
-                ID=ID,
-                file_grp=self.output_file_grp,
-                pageId=input_file.pageId,
-                mimetype=MIMETYPE_PAGE,
-                #url=base + ".pf.png",
-                local_filename='%s/%s' % (self.output_file_grp, ID),
-                content=to_xml(pcgts).encode('utf-8')
-            )
+            if len(textarea) == 0:
+                return self.select_borderLine(
+                    img_array_rr, lineDetectH, lineDetectV), False
+            return textarea[0], True
+        elif len(textarea) == 1 and (height*width*0.5 < (abs(textarea[0][2]-textarea[0][0]) * abs(textarea[0][3]-textarea[0][1]))):
+            x1, y1, x2, y2 = textarea[0]
+            x1 = x1-20 if x1 > 20 else 0
+            x2 = x2+20 if x2 < width-20 else width
+            y1 = y1-40 if y1 > 40 else 0
+            y2 = y2+40 if y2 < height-40 else height
+
+            #self.save_pf(base, [x1, y1, x2, y2])
+            return textarea[0], True
+        return self.select_borderLine(
+            img_array_rr, lineDetectH, lineDetectV), False
+
+    def refine_edge(self, ink, rows, edge, radius, lower):
+        """
+        Move the lower (or upper) column bound `edge` of the content in
+        `rows` of the boolean `ink` image by at most `radius` to the
+        outermost column of a glyph-sized (> 15 pixels) ink component, or
+        keep it if there is none. Components are taken from 32 extra
+        columns inwards, so that glyphs cut by the window still count.
+        """
+        width = ink.shape[1]
+        if lower:
+            c0, c1 = max(0, edge-radius), min(width, edge+radius+33)
+        else:
+            c0, c1 = max(0, edge-radius-32), min(width, edge+radius+1)
+        strip = np.ascontiguousarray(ink[rows, c0:c1], dtype=np.uint8)
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(strip, connectivity=8)
+        glyph = ((stats[:, cv2.CC_STAT_WIDTH] > 15) |
+                 (stats[:, cv2.CC_STAT_HEIGHT] > 15))
+        glyph[0] = False
+        hits = np.flatnonzero(glyph[labels].any(axis=0)) + c0
+        hits = hits[abs(hits-edge) <= radius]
+        if len(hits) == 0:
+            return edge
+        return int(hits[0] if lower else hits[-1])
+
+    def refine_border(self, img_array, border, radius):
+        """
+        Refine each edge of the `border` box on the full resolution
+        `img_array` (see `refine_edge`), with foreground being darker than
+        the midrange.
+        """
+        import ocrolib
+
+        min_x, min_y, max_x, max_y = border
+        ink = img_array < ocrolib.midrange(img_array)
+        rows = slice(min_y, max_y+1)
+        min_x = self.refine_edge(ink, rows, min_x, radius, True)
+        max_x = self.refine_edge(ink, rows, max_x, radius, False)
+        cols = slice(min_x, max_x+1)
+        min_y = self.refine_edge(ink.T, cols, min_y, radius, True)
+        max_y = self.refine_edge(ink.T, cols, max_y, radius, False)
+        return min_x, min_y, max_x, max_y
+
+    def crop_page(self, fname, filename):
+        """
+        Detect the page content area of the image `filename` (for
+        `imageFilename` `fname`). Returns its bounding box
+        `(min_x, min_y, max_x, max_y)`.
+
+        With `analysisSize`, detection runs on the page downscaled to that
+        long edge (with its pixel distances scaled along), and the box is
+        scaled back; if it was derived from text areas, `refine` then
+        adjusts its edges at full resolution.
+        """
+        print("Process file: ", fname)
+        img_array = read_page(filename, 'L')
+        height, width = img_array.shape
+        size = self.parameter['analysisSize']
+        self.pixelScale = 1.0
+        if 0 < size < max(height, width):
+            scale = self.pixelScale = float(size) / max(height, width)
+            with span('downscale'):
+                small = cv2.resize(img_array, (max(1, int(round(width*scale))),
+                                               max(1, int(round(height*scale)))),
+                                   interpolation=cv2.INTER_AREA)
+            (min_x, min_y, max_x, max_y), textual = self.detect_border(small)
+            min_x, min_y = int(min_x/scale), int(min_y/scale)
+            max_x = min(width, int(np.ceil(max_x/scale)))
+            max_y = min(height, int(np.ceil(max_y/scale)))
+            if self.parameter['refine'] and textual:
+                with span('refine'):
+                    min_x, min_y, max_x, max_y = self.refine_border(
+                        img_array, (min_x, min_y, max_x, max_y),
+                        int(np.ceil(1/scale)) + 1)
+        else:
+            # the detection draws on the page
+            (min_x, min_y, max_x, max_y), _ = self.detect_border(np.array(img_array))
+
+        return min_x, min_y, max_x, max_y
+
+    def process(self):
+        pages = []
+        for (n, input_file) in enumerate(self.input_files):
+            with span('input'):
+                pcgts = page_from_file(self.workspace.download_file(input_file))
+                fname = pcgts.get_Page().imageFilename
+                filename = self.workspace.download_url(fname)
+            pages.append((n, input_file, pcgts, fname, filename))
+
+        borders = map_cached_pages(self, 'crop_page', [
+            (fname, filename) for (_, _, _, fname, filename) in pages], [
+            page_key(self, fname, filename) for (_, _, _, fname, filename) in pages])
+        with write_behind(self.parameter['writeBehind']):
+            for border, (n, input_file, pcgts, _, _) in zip(borders, pages):
+                if border is None:
+                    continue
+                min_x, min_y, max_x, max_y = border
+                brd = BorderType(Coords=CoordsType("%i,%i %i,%i %i,%i %i,%i" % (
+                    min_x, min_y, max_x, min_y, max_x, max_y, min_x, max_y)))
+                pcgts.get_Page().set_Border(brd)
+
+                ID = concat_padded(self.output_file_grp, n)
+                with span('xml'):
+                    content = to_xml(pcgts).encode('utf-8')
+                with span('add_file'):
+                    submit_write(
+                        self.workspace.add_file,
+                        ID=ID,
+                        file_grp=self.output_file_grp,
+                        pageId=input_file.pageId,
+                        mimetype=MIMETYPE_PAGE,
+                        #url=base + ".pf.png",
+                        local_filename='%s/%s' % (self.output_file_grp, ID),
+                        content=content
+                    )
+        report_timings()
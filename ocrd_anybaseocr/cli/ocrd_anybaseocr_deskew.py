@@ -43,11 +43,14 @@
 
 
 import numpy as np
-from pylab import amin, amax, linspace, mean, var, plot, ginput, ones, clip, imshow
-from scipy.ndimage import filters, interpolation, morphology
-from scipy import stats
-import ocrolib
-from ..utils import print_info
+from ..utils import print_info, allsplitext
+from ..skew import projection_variances, rotate_page
+from ..parallel import page_workers
+from ..cache import map_cached_pages, page_key
+from ..threshold import estimate_thresholds
+from ..image import read_page, gray_image, write_binary_image, BILEVEL_FORMATS
+from ..timing import span, report_timings
+from ..pipeline import write_behind, submit_write
 from ..constants import OCRD_TOOL
 
 from ocrd import Processor
@@ -64,107 +67,170 @@ class OcrdAnybaseocrDeskewer(Processor):
         kwargs['version'] = OCRD_TOOL['version']
         super(OcrdAnybaseocrDeskewer, self).__init__(*args, **kwargs)
 
-    def estimate_skew_angle(self, image, angles):
-        param = self.parameter
-        estimates = []
+    def page_images(self, fname, filename):
+        """
+        Images the page methods read for `filename`, as `(filename, mode)`
+        (see `prefetch_pages`).
+        """
+        return [(filename, None)]
 
+    def score_skew_angles(self, image, angles):
+        if self.parameter['skewscore'] == 'projection':
+            return list(projection_variances(image, angles))
+        from scipy.ndimage import interpolation
+
+        estimates = []
         for a in angles:
-            v = mean(interpolation.rotate(
+            v = np.mean(interpolation.rotate(
                 image, a, order=0, mode='constant'), axis=1)
-            v = var(v)
-            estimates.append((v, a))
+            estimates.append(np.var(v))
+        return estimates
+
+    def estimate_skew_angle(self, image, angles):
+        param = self.parameter
+        if param['skewmode'] == 'coarse-to-fine':
+            return self.estimate_skew_angle_coarse_to_fine(image, angles)
+        estimates = list(zip(self.score_skew_angles(image, angles), angles))
         if param['debug'] > 0:
-            plot([y for x, y in estimates], [x for x, y in estimates])
-            ginput(1, param['debug'])
+            import matplotlib.pyplot as plt
+            plt.plot([y for x, y in estimates], [x for x, y in estimates])
+            plt.ginput(1, param['debug'])
         _, a = max(estimates)
         return a
 
-    def process(self):
-        for (n, input_file) in enumerate(self.input_files):
-            pcgts = page_from_file(self.workspace.download_file(input_file))
-            fname = pcgts.get_Page().imageFilename
-            img = self.workspace.resolve_image_as_pil(fname)
-            param = self.parameter
-            base, _ = ocrolib.allsplitext(fname)
-            #basefile = ocrolib.allsplitext(os.path.basename(fpath))[0]
-
-            if param['parallel'] < 2:
-                print_info("=== %s " % (fname))
-            raw = ocrolib.read_image_gray(img.filename)
-
-            flat = raw
-            #flat = np.array(binImg)
-            # estimate skew angle and rotate
-            if param['maxskew'] > 0:
-                if param['parallel'] < 2:
-                    print_info("estimating skew angle")
-                d0, d1 = flat.shape
-                o0, o1 = int(param['bignore']*d0), int(param['bignore']*d1)
-                flat = amax(flat)-flat
-                flat -= amin(flat)
-                est = flat[o0:d0-o0, o1:d1-o1]
-                ma = param['maxskew']
-                ms = int(2*param['maxskew']*param['skewsteps'])
-                angle = self.estimate_skew_angle(est, linspace(-ma, ma, ms+1))
-                flat = interpolation.rotate(
-                    flat, angle, mode='constant', reshape=0)
-                flat = amax(flat)-flat
-            else:
-                angle = 0
-
-            # self.write_angles_to_pageXML(base,angle)
-            # estimate low and high thresholds
-            if param['parallel'] < 2:
-                print_info("estimating thresholds")
+    def estimate_skew_angle_coarse_to_fine(self, image, angles):
+        """
+        Search the same angle grid as the exhaustive mode, but score every
+        `zoom`-th angle on an image decimated by `zoom` first, then refine
+        around the best candidate at full resolution in a window that is
+        halved on each step until it reaches the grid resolution.
+        """
+        # decimation factor: a power of two, so that the refinement
+        # steps always land on the exhaustive angle grid
+        zoom = 1
+        while zoom * 2 <= max(image.shape) / 1000.0 and zoom * 2 < len(angles):
+            zoom *= 2
+        h, w = image.shape[0] // zoom * zoom, image.shape[1] // zoom * zoom
+        small = image[:h, :w].reshape(
+            h // zoom, zoom, w // zoom, zoom).mean(axis=(1, 3))
+
+        last = len(angles) - 1
+        coarse = list(range(0, last, zoom)) + [last]
+        _, best = max(zip(self.score_skew_angles(
+            small, [angles[i] for i in coarse]), coarse))
+
+        scores = {}
+        step = zoom // 2
+        while step >= 1:
+            candidates = [i for i in (best - step, best, best + step)
+                          if 0 <= i <= last]
+            todo = [i for i in candidates if i not in scores]
+            if todo:
+                scores.update(zip(todo, self.score_skew_angles(
+                    image, [angles[i] for i in todo])))
+            _, best = max((scores[i], i) for i in candidates)
+            step //= 2
+        return angles[best]
+
+    def deskew_page(self, fname, filename):
+        """
+        Deskew and binarize the image `filename` (for `imageFilename`
+        `fname`) and write it as `.ds.png` (or `.ds.tif`, see `format`) next
+        to `fname`. Returns the path written and the skew angle.
+        """
+        param = self.parameter
+        base, _ = allsplitext(fname)
+        #basefile = allsplitext(os.path.basename(fpath))[0]
+
+        if page_workers(param) < 2:
+            print_info("=== %s " % (fname))
+        raw = gray_image(read_page(filename), param['precision'])
+
+        flat = raw
+        #flat = np.array(binImg)
+        # estimate skew angle and rotate
+        if param['maxskew'] > 0:
             d0, d1 = flat.shape
             o0, o1 = int(param['bignore']*d0), int(param['bignore']*d1)
+            # invert and normalize in place, raw is not used afterwards
+            with span('normalize'):
+                np.subtract(np.amax(flat), flat, out=flat)
+                flat -= np.amin(flat)
             est = flat[o0:d0-o0, o1:d1-o1]
-            if param['escale'] > 0:
-                # by default, we use only regions that contain
-                # significant variance; this makes the percentile
-                # based low and high estimates more reliable
-                e = param['escale']
-                v = est-filters.gaussian_filter(est, e*20.0)
-                v = filters.gaussian_filter(v**2, e*20.0)**0.5
-                v = (v > 0.3*amax(v))
-                v = morphology.binary_dilation(
-                    v, structure=ones((int(e*50), 1)))
-                v = morphology.binary_dilation(
-                    v, structure=ones((1, int(e*50))))
-                if param['debug'] > 0:
-                    imshow(v)
-                    ginput(1, param['debug'])
-                est = est[v]
-            lo = stats.scoreatpercentile(est.ravel(), param['lo'])
-            hi = stats.scoreatpercentile(est.ravel(), param['hi'])
-            # rescale the image to get the gray scale image
-            if param['parallel'] < 2:
-                print_info("rescaling")
+            ma = param['maxskew']
+            ms = int(2*param['maxskew']*param['skewsteps'])
+            with span('skew'):
+                angle = self.estimate_skew_angle(est, np.linspace(-ma, ma, ms+1))
+            with span('rotate'):
+                flat = rotate_page(flat, angle, param['rotateorder'],
+                                   param['rotatetolerance'])
+                np.subtract(np.amax(flat), flat, out=flat)
+        else:
+            angle = 0
+
+        # self.write_angles_to_pageXML(base,angle)
+        # estimate low and high thresholds
+        def show(v):
+            if param['debug'] > 0:
+                import matplotlib.pyplot as plt
+                plt.imshow(v)
+                plt.ginput(1, param['debug'])
+        with span('thresholds'):
+            lo, hi = estimate_thresholds(
+                flat, param['bignore'], param['escale'], param['lo'], param['hi'],
+                show=show)
+        # rescale the image to get the gray scale image
+        with span('rescale'):
             flat -= lo
             flat /= (hi-lo)
-            flat = clip(flat, 0, 1)
-            if param['debug'] > 0:
-                imshow(flat, vmin=0, vmax=1)
-                ginput(1, param['debug'])
-            deskewed = 1*(flat > param['threshold'])
-
-            # output the normalized grayscale and the thresholded images
-            print_info("%s lo-hi (%.2f %.2f) angle %4.1f" %
-                       (pcgts.get_Page().imageFilename, lo, hi, angle))
-            if param['parallel'] < 2:
-                print_info("writing")
-            ocrolib.write_image_binary(base+".ds.png", deskewed)
-
-            orientation = TextRegionType(orientation=angle)
-            pcgts.get_Page().add_TextRegion(orientation)
-
-            ID = concat_padded(self.output_file_grp, n)
-            self.workspace.add_file(
-                ID=ID,
-                file_grp=self.output_file_grp,
-                pageId=input_file.pageId,
-                mimetype="image/png",
-                url=base + ".ds.png",
-                local_filename='%s/%s' % (self.output_file_grp, ID),
-                content=to_xml(pcgts).encode('utf-8')
-            )
+            np.clip(flat, 0, 1, out=flat)
+        if param['debug'] > 0:
+            import matplotlib.pyplot as plt
+            plt.imshow(flat, vmin=0, vmax=1)
+            plt.ginput(1, param['debug'])
+        with span('binarize'):
+            deskewed = (flat > param['threshold']).view(np.uint8)
+
+        # output the normalized grayscale and the thresholded images
+        print_info("%s lo-hi (%.2f %.2f) angle %4.1f" %
+                   (fname, lo, hi, angle))
+        ext, _ = BILEVEL_FORMATS[param['format']]
+        with span('write'):
+            write_binary_image(base + ".ds" + ext, deskewed, param['compression'])
+        return base + ".ds" + ext, angle
+
+    def process(self):
+        pages = []
+        for (n, input_file) in enumerate(self.input_files):
+            with span('input'):
+                pcgts = page_from_file(self.workspace.download_file(input_file))
+                fname = pcgts.get_Page().imageFilename
+                filename = self.workspace.download_url(fname)
+            pages.append((n, input_file, pcgts, fname, filename))
+
+        deskewed = map_cached_pages(self, 'deskew_page', [
+            (fname, filename) for (_, _, _, fname, filename) in pages], [
+            page_key(self, fname, filename) for (_, _, _, fname, filename) in pages])
+        with write_behind(self.parameter['writeBehind']):
+            for result, (n, input_file, pcgts, _, _) in zip(deskewed, pages):
+                if result is None:
+                    continue
+                url, angle = result
+                orientation = TextRegionType(orientation=angle)
+                pcgts.get_Page().add_TextRegion(orientation)
+
+                ID = concat_padded(self.output_file_grp, n)
+                with span('xml'):
+                    content = to_xml(pcgts).encode('utf-8')
+                with span('add_file'):
+                    submit_write(
+                        self.workspace.add_file,
+                        ID=ID,
+                        file_grp=self.output_file_grp,
+                        pageId=input_file.pageId,
+                        mimetype=BILEVEL_FORMATS[self.parameter['format']][1],
+                        url=url,
+                        local_filename='%s/%s' % (self.output_file_grp, ID),
+                        content=content
+                    )
+        report_timings()
@@ -1,21 +1,31 @@
-import torch
 import sys
 import os
-import shutil
 
 from ..constants import OCRD_TOOL
+from ..utils import allsplitext
+from ..cache import map_cached_pages, page_key
+from ..image import read_page, write_image
+from ..timing import span, report_timings
+from ..pipeline import write_behind, submit_write
 
 from ocrd import Processor
 
-from ocrd_models.ocrd_page import parse
 from ocrd_utils import getLogger, concat_padded
 from ocrd_modelfactory import page_from_file
-from ocrd_models.ocrd_page import to_xml,parse
-import shutil
+from ocrd_models.ocrd_page import to_xml, parse
 
 from pathlib import Path
 from PIL import Image
-import ocrolib
+import numpy as np
+
+
+def inference_mode():
+    """
+    Context in which torch computes no gradients (torch < 1.9 has no
+    inference mode, only `no_grad`).
+    """
+    import torch
+    return getattr(torch, 'inference_mode', torch.no_grad)()
 
 
 class OcrdAnybaseocrDewarper(Processor):
@@ -24,16 +34,147 @@ class OcrdAnybaseocrDewarper(Processor):
         kwargs['ocrd_tool'] = OCRD_TOOL['tools']['ocrd-anybaseocr-dewarp']
         kwargs['version'] = OCRD_TOOL['version']
         super(OcrdAnybaseocrDewarper, self).__init__(*args, **kwargs)
+        self.model = None
+        self.device = None
+
+    def page_images(self, fname, crop_region):
+        """
+        Images the page methods read for `fname`, as `(filename, mode)`
+        (see `prefetch_pages`).
+        """
+        return [(fname, 'RGB')]
 
     def crop_image(self, image_path, crop_region):
-        img = Image.open(image_path)
+        img = Image.fromarray(read_page(image_path, 'RGB'))
         cropped = img.crop(crop_region)
         return cropped
 
+    def select_device(self):
+        """
+        Torch device for the generator: the GPU `gpu_id` or the CPU, as
+        requested by `device` ('auto' prefers the GPU if there is one).
+        """
+        import torch
+
+        device = self.parameter['device']
+        if device == 'auto':
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        if device == 'cuda':
+            return torch.device('cuda', self.parameter['gpu_id'])
+        return torch.device('cpu')
+
+    def pix2pixhd_options(self):
+        """
+        pix2pixHD test options, as `test.py` would parse them from the
+        command line previously used for dewarping.
+        """
+        from options.test_options import TestOptions
+
+        param = self.parameter
+        options = TestOptions()
+        options.initialize()
+        opt = options.parser.parse_args([
+            '--checkpoints_dir', './',
+            '--name', 'models',
+            '--label_nc', '0',
+            '--no_instance',
+            '--no_flip',
+            '--n_blocks_global', '10',
+            '--n_local_enhancers', '2',
+            '--gpu_ids', str(self.device.index) if self.device.type == 'cuda' else '-1',
+            '--loadSize', str(param['resizeHeight']),
+            '--fineSize', str(param['resizeWidth']),
+            '--resize_or_crop', param['imgresize'],
+        ])
+        opt.isTrain = options.isTrain
+        opt.gpu_ids = [int(i) for i in opt.gpu_ids.split(',') if int(i) >= 0]
+        opt.nThreads = 1
+        opt.batchSize = 1
+        opt.serial_batches = True
+        return opt
+
+    def load_model(self):
+        """
+        Load the pix2pixHD generator once per processor instance (i.e. once
+        per worker process), instead of once per `test.py` invocation.
+
+        The generator is built like pix2pixHD's inference model does, but
+        its weights are mapped to the selected device, so that checkpoints
+        saved on a GPU also load on machines without one. On the CPU, the
+        generator runs channels-last with `threads` intra-op threads.
+        """
+        if self.model is not None:
+            return self.model
+        import torch
+
+        param = self.parameter
+        path = str(Path(param['pix2pixHD']).absolute())
+        if path not in sys.path:
+            sys.path.insert(0, path)
+        from models.networks import define_G
+
+        self.device = self.select_device()
+        opt = self.opt = self.pix2pixhd_options()
+        model = define_G(opt.input_nc, opt.output_nc, opt.ngf, opt.netG,
+                         opt.n_downsample_global, opt.n_blocks_global,
+                         opt.n_local_enhancers, opt.n_blocks_local, opt.norm)
+        weights = os.path.join(opt.checkpoints_dir, opt.name,
+                               '%s_net_G.pth' % opt.which_epoch)
+        model.load_state_dict(torch.load(weights, map_location='cpu'))
+        model.eval()
+        if self.device.type == 'cuda':
+            torch.cuda.set_device(self.device)
+            model = model.to(self.device)
+        else:
+            if param['threads'] > 0:
+                torch.set_num_threads(param['threads'])
+            model = model.to(memory_format=torch.channels_last)
+        self.model = model
+        return self.model
+
+    def dewarp_image(self, image):
+        """
+        Run the pix2pixHD generator on the PIL `image` in memory and return
+        the synthesized image (RGB, uint8).
+        """
+        import torch
+        from data.base_dataset import get_params, get_transform
+        from util.util import tensor2im
+
+        with span('model'):
+            model = self.load_model()
+        with span('transform'):
+            image = image.convert('RGB')
+            transform = get_transform(self.opt, get_params(self.opt, image.size))
+            label = transform(image).unsqueeze(0).to(self.device)
+            if self.device.type == 'cpu':
+                label = label.contiguous(memory_format=torch.channels_last)
+        # with label_nc 0, no instance maps and no features, pix2pixHD's
+        # inference passes the input image unchanged to the generator
+        with span('inference'), inference_mode():
+            generated = model(label)
+        with span('transform'):
+            return tensor2im(generated.data[0])
+
+    def dewarp_page(self, fname, crop_region):
+        """
+        Crop `crop_region` out of the image `fname`, dewarp it and write the
+        result next to `fname` as `.dw.png`. Returns the file name used.
+        """
+        cropped_img = self.crop_image(fname, crop_region)
+        dewarped = self.dewarp_image(cropped_img)
+
+        base, _ = allsplitext(fname)
+        filename = base + ".dw.png"
+        with span('write'):
+            write_image(filename, Image.fromarray(np.asarray(dewarped, dtype=np.uint8)))
+        return filename
+
     def process(self):
+        import torch
 
-        if not torch.cuda.is_available():
-            print("Your system has no CUDA installed. No GPU detected.")
+        if self.parameter['device'] == 'cuda' and not torch.cuda.is_available():
+            print("Your system has no CUDA installed. No GPU detected. Use `device` 'cpu' instead.")
             sys.exit(1)
 
         path = Path(self.parameter['pix2pixHD']).absolute()
@@ -46,45 +187,48 @@ class OcrdAnybaseocrDewarper(Processor):
                 """ % path)
             sys.exit(1)
 
-
-        for (_, input_file) in enumerate(self.input_files):
-            local_input_file = self.workspace.download_file(input_file)
-            pcgts = parse(local_input_file.url, silence=True)
-            image_coords = pcgts.get_Page().get_Border().get_Coords().points.split()
-            fname = pcgts.get_Page().imageFilename
-
+        pages = []
+        for (n, input_file) in enumerate(self.input_files):
+            with span('input'):
+                local_input_file = self.workspace.download_file(input_file)
+                pcgts = parse(local_input_file.url, silence=True)
+                image_coords = pcgts.get_Page().get_Border().get_Coords().points.split()
+                fname = pcgts.get_Page().imageFilename
 
             # Get page Co-ordinates
             min_x, min_y = image_coords[0].split(",")
             max_x, max_y = image_coords[2].split(",")
-            img_tmp_dir = "OCR-D-IMG/test_A"
-            img_dir = os.path.dirname(str(fname))
-            # Path of pix2pixHD
-            Path(img_tmp_dir).mkdir(parents=True, exist_ok=True)
 
             crop_region = int(min_x), int(
                 min_y), int(max_x), int(max_y)
-            cropped_img = self.crop_image(fname, crop_region)
-
-
-            base, _ = ocrolib.allsplitext(fname)
-            filename = base.split("/")[-1] + ".png"
-            cropped_img.save(img_tmp_dir + "/" + filename)
-            #os.system("cp %s %s" % (str(fname), os.path.join(img_tmp_dir, os.path.basename(str(fname)))))
-            #os.system("mkdir -p %s" % img_tmp_dir)
-            #os.system("cp %s %s" % (str(fname), os.path.join(img_tmp_dir, os.path.basename(str(fname)))))
-        os.system("python " + str(path) + "/test.py --dataroot %s --checkpoints_dir ./ --name models --results_dir %s --label_nc 0 --no_instance --no_flip --resize_or_crop none --n_blocks_global 10 --n_local_enhancers 2 --gpu_ids %s --loadSize %d --fineSize %d --resize_or_crop %s" %
-                  (os.path.dirname(img_tmp_dir), img_dir, self.parameter['gpu_id'], self.parameter['resizeHeight'], self.parameter['resizeWidth'], self.parameter['imgresize']))
-        synthesized_image = filename.split(
-            ".")[0] + "_synthesized_image.jpg"
-        pix2pix_img_dir = img_dir + "/models/test_latest/images/"
-        dewarped_image = Path(pix2pix_img_dir + synthesized_image)
-        if(dewarped_image.is_file()):
-            shutil.copy(dewarped_image, img_dir + "/" +
-                        filename.split(".")[0] + "_dw.jpg")
-
-        if(Path(img_tmp_dir).is_dir()):
-            shutil.rmtree(img_tmp_dir)
-        if(Path(img_dir + "/models").is_dir()):
-            shutil.rmtree(img_dir + "/models")
-
+            pages.append((n, input_file, pcgts, fname, crop_region))
+
+        # the generator weights are identified by size and modification time
+        weights = Path('models/latest_net_G.pth')
+        if weights.exists():
+            weights = (weights.stat().st_size, weights.stat().st_mtime)
+        else:
+            weights = None
+        results = map_cached_pages(self, 'dewarp_page', [
+            (fname, crop_region) for (_, _, _, fname, crop_region) in pages], [
+            page_key(self, fname, fname, crop_region, weights)
+            for (_, _, _, fname, crop_region) in pages])
+        with write_behind(self.parameter['writeBehind']):
+            for filename, (n, input_file, pcgts, _, _) in zip(results, pages):
+                if filename is None:
+                    continue
+                ID = concat_padded(self.output_file_grp, n)
+                with span('xml'):
+                    content = to_xml(pcgts).encode('utf-8')
+                with span('add_file'):
+                    submit_write(
+                        self.workspace.add_file,
+                        ID=ID,
+                        file_grp=self.output_file_grp,
+                        pageId=input_file.pageId,
+                        mimetype="image/png",
+                        url=filename,
+                        local_filename='%s/%s' % (self.output_file_grp, ID),
+                        content=content
+                    )
+        report_timings()
@@ -1,8 +1,8 @@
+import os
 import json
-from pkg_resources import resource_string
 
 __all__ = ['OCRD_TOOL']
 
-OCRD_TOOL = json.loads(resource_string(
-    __name__, 'ocrd-tool.json').decode('utf8'))
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ocrd-tool.json'), 'rb') as f:
+    OCRD_TOOL = json.loads(f.read().decode('utf8'))
 pix2pixHD_url = "https://github.com/NVIDIA/pix2pixHD"
@@ -0,0 +1,135 @@
+import numpy as np
+from PIL import Image
+
+from .timing import span
+from .pipeline import prefetch, submit_write
+
+__all__ = [
+    'read_page',
+    'prefetch_pages',
+    'gray_image',
+    'BILEVEL_FORMATS',
+    'write_binary_image',
+    'write_image',
+]
+
+# image modes numpy takes over as they are; others (bilevel, palette,
+# CMYK, ...) are converted to 8-bit grayscale, like `ocrolib.pil2array`
+ARRAY_MODES = ('L', 'I;16', 'I', 'F', 'RGB', 'RGBA')
+
+# bilevel output formats: file name extension and media type
+BILEVEL_FORMATS = {
+    'png': ('.png', 'image/png'),
+    'tiff': ('.tif', 'image/tiff'),
+}
+
+# decoded pages by (filename, mode), as futures, while they are prefetched
+_prefetched = {}
+
+# ranges of integer pixels, as `ocrolib.read_image_gray` divides by them
+GRAY_SCALES = {
+    np.dtype(np.uint8): 255.0,
+    np.dtype(np.int8): 127.0,
+    np.dtype(np.uint16): 65536.0,
+    np.dtype(np.int16): 32767.0,
+}
+
+
+def decode_page(filename, mode=None):
+    img = Image.open(filename)
+    if mode is not None and img.mode != mode:
+        img = img.convert(mode)
+    elif img.mode not in ARRAY_MODES:
+        img = img.convert('L')
+    return np.asarray(img)
+
+
+def read_page(filename, mode=None):
+    """
+    Decode the image `filename` once into an array of its pixels:
+    2-dimensional for grayscale, 3-dimensional for RGB(A). With `mode`,
+    the image is converted to that PIL mode first (e.g. 'L' for 8-bit
+    grayscale). If the page is being prefetched (see `prefetch_pages`),
+    its decoding is waited for instead.
+
+    The array is a read-only view of the decoded pixels, which page
+    methods share between all of their stages instead of reading the
+    file again; stages that draw on the page must copy it.
+    """
+    future = _prefetched.pop((filename, mode), None)
+    with span('decode'):
+        if future is not None:
+            return future.result()
+        return decode_page(filename, mode)
+
+
+def prefetch_pages(jobs, images, depth):
+    """
+    Yield the page `jobs` in order, while the images of the next `depth`
+    jobs are decoded on background threads for `read_page` to take up.
+    `images(*job)` lists the `(filename, mode)` a job reads.
+    """
+    def fetch(executor, job):
+        for image in images(*job):
+            if image not in _prefetched:
+                _prefetched[image] = executor.submit(decode_page, *image)
+
+    previous = []
+    try:
+        for job in prefetch(jobs, fetch, depth):
+            # drop what the previous job did not read (e.g. on cache hits)
+            for image in previous:
+                _prefetched.pop(image, None)
+            previous = images(*job)
+            yield job
+    finally:
+        _prefetched.clear()
+
+
+def gray_image(pixels, dtype=np.float64):
+    """
+    Grayscale image of `pixels` (see `read_page`) in a new array of
+    `dtype`, scaled like `ocrolib.read_image_gray`: integer pixels are
+    divided by their range, colour channels are averaged (ignoring
+    alpha). Grayscale pixels are converted and scaled in a single pass.
+    """
+    scale = GRAY_SCALES.get(pixels.dtype, 1.0)
+    if pixels.ndim == 3:
+        gray = pixels[:, :, :3].mean(axis=2)
+        gray /= scale
+        return gray.astype(dtype, copy=False)
+    return np.divide(pixels, scale, dtype=dtype)
+
+
+def _save_binary(path, image, compression):
+    bilevel = image.dtype == np.bool_ or (image.dtype == np.uint8 and np.amax(image) <= 1)
+    if not bilevel:
+        # like ocrolib.write_image_binary: threshold at the midrange
+        image = image > 0.5*(np.amin(image)+np.amax(image))
+    # rows of 1-bit pixels, most significant bit first, as PIL's mode '1'
+    height, width = image.shape
+    bits = Image.frombytes('1', (width, height), np.packbits(image, axis=1).tobytes())
+    if path.endswith(BILEVEL_FORMATS['tiff'][0]):
+        bits.save(path, compression='group4')
+    else:
+        bits.save(path, compress_level=compression)
+
+
+def write_binary_image(path, image, compression=6):
+    """
+    Write the bilevel `image` as a 1-bit image to `path`: a PNG with
+    zlib `compression` level (0-9), or, if `path` ends in '.tif', a TIFF
+    with CCITT Group 4 compression. Boolean and 0/1 byte images are packed
+    as they are (1 is white), others become white above their midrange,
+    like with `ocrolib.write_image_binary`. The image is written on the
+    write-behind queue if there is one (see `submit_write`).
+    """
+    submit_write(_save_binary, path, image, compression)
+
+
+def write_image(path, image):
+    """
+    Write the PIL `image` to `path`, on the write-behind queue if there
+    is one (see `submit_write`).
+    """
+    submit_write(image.save, path)
@@ -0,0 +1,97 @@
+import os
+import json
+
+__all__ = [
+    'PageJournal',
+    'open_journal',
+]
+
+
+def _files(result):
+    if isinstance(result, str):
+        return [result]
+    if isinstance(result, (list, tuple)):
+        return [path for value in result for path in _files(value)]
+    return []
+
+
+class PageJournal(object):
+    """
+    Append-only progress journal of a processor run in the file `path`:
+    one JSON line per finished page with its key (see `page_key`, which
+    fingerprints the image, the tool, its version and the parameters) and
+    its result, or the error it failed with.
+
+    With `resume`, the pages an earlier run finished are read back, so
+    that `lookup` finds them; otherwise the journal starts empty. A line
+    cut short by a crash ends the pages read back.
+    """
+
+    def __init__(self, path, resume):
+        self.path = path
+        self.done = {}
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    if 'error' in entry:
+                        self.done.pop(entry['key'], None)
+                    else:
+                        self.done[entry['key']] = entry['result']
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = open(path, 'a' if resume else 'w')
+
+    def lookup(self, key):
+        """
+        Whether the page of `key` was finished, and its result. Pages
+        whose output files no longer exist count as not finished.
+        """
+        if key not in self.done:
+            return False, None
+        result = self.done[key]
+        if not all(os.path.isfile(path) for path in _files(result)):
+            return False, None
+        return True, result
+
+    def _write(self, entry):
+        # numpy scalars become numbers
+        self.file.write(json.dumps(entry, separators=(',', ':'),
+                                   default=lambda value: value.item()) + '\n')
+        self.file.flush()
+
+    def record(self, key, result):
+        """
+        Note the page of `key` as finished with `result`. Callers write
+        its output files first.
+        """
+        self._write({'key': key, 'result': result})
+
+    def record_error(self, key, error):
+        """
+        Note the page of `key` as failed with the message `error`, so that
+        a resumed run tries it again.
+        """
+        self._write({'key': key, 'error': error})
+
+    def close(self):
+        self.file.close()
+
+
+def open_journal(processor):
+    """
+    The journal of the processor's run, in the directory of its (first)
+    output file group, or None without a workspace. The `resume`
+    parameter decides whether an earlier run's journal is continued.
+    """
+    workspace = getattr(processor, 'workspace', None)
+    if workspace is None:
+        return None
+    file_grp = processor.output_file_grp.split(',')[0]
+    path = os.path.join(workspace.directory, file_grp,
+                        '.%s.journal' % processor.ocrd_tool['executable'])
+    return PageJournal(path, processor.parameter.get('resume', False))
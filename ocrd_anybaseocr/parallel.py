@@ -0,0 +1,165 @@
+import os
+import sys
+import traceback
+import multiprocessing
+
+from .timing import (span, profile_page, timing_enabled, enable_timing,
+                     take_timings, merge_timings)
+from .image import prefetch_pages
+from .utils import print_error
+
+__all__ = [
+    'PARALLEL_ENV',
+    'page_workers',
+    'limit_threads',
+    'PageFailure',
+    'run_page',
+    'try_page',
+    'map_pages',
+]
+
+# environment variable consulted when a processor's `parallel` parameter is 0
+PARALLEL_ENV = 'OCRD_ANYBASEOCR_PARALLEL'
+
+THREAD_ENV = [
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+]
+
+
+def page_workers(parameter):
+    """
+    Number of worker processes for page-level parallelism: the `parallel`
+    parameter if set, otherwise $OCRD_ANYBASEOCR_PARALLEL. Values below 2
+    mean sequential processing in the calling process.
+    """
+    workers = int(parameter.get('parallel', 0))
+    if workers <= 0:
+        workers = int(os.environ.get(PARALLEL_ENV, 0) or 0)
+    return workers
+
+
+def limit_threads(threads):
+    """
+    Cap the threads OpenCV, BLAS/OpenMP and torch may use in this process,
+    so that several worker processes do not oversubscribe the machine.
+    """
+    for var in THREAD_ENV:
+        os.environ[var] = str(threads)
+    try:
+        import cv2
+        cv2.setNumThreads(threads)
+    except ImportError:
+        pass
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+
+
+def run_page(processor, method, args):
+    """
+    Call `processor.<method>(*args)` as span `method`, profiling it if
+    requested for its page (see `profile_page`; the first argument of
+    all page methods is the page's `imageFilename`).
+    """
+    with profile_page(args[0] if args else None, method):
+        with span(method):
+            return getattr(processor, method)(*args)
+
+
+class PageFailure(object):
+    """
+    Stands in for the result of a page method that raised an exception,
+    with the exception's `message`.
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+def try_page(processor, method, args):
+    """
+    Like `run_page`, but if the method raises an exception, print its
+    traceback and return a `PageFailure` instead.
+    """
+    try:
+        return run_page(processor, method, args)
+    except Exception as err:
+        print_error("%s failed for %s, skipping the page:\n%s" % (
+            method, args[0] if args else None, traceback.format_exc()))
+        return PageFailure('%s: %s' % (type(err).__name__, err))
+
+
+_processor = None
+
+
+def _init_worker(processor_class, parameter, threads, timing):
+    global _processor
+    limit_threads(threads)
+    enable_timing(timing)
+    _processor = processor_class(None, parameter=parameter)
+
+
+def _run_page(job):
+    method, args = job
+    # the spans of the page go back with its result
+    return try_page(_processor, method, args), take_timings()
+
+
+def _map_serial(processor, method, jobs):
+    images = getattr(processor, 'page_images', None)
+    if images is not None:
+        jobs = prefetch_pages(jobs, images, processor.parameter.get('prefetch', 0))
+    for args in jobs:
+        yield try_page(processor, method, args)
+
+
+def _map_pool(pool, method, jobs):
+    try:
+        for result, timings in pool.imap(_run_page, [(method, args) for args in jobs]):
+            merge_timings(timings)
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def map_pages(processor, method, jobs):
+    """
+    Call `processor.<method>(*args)` for every `args` in `jobs` and return
+    an iterator over the results in the order of `jobs`.
+
+    With 2 or more workers (see `page_workers`), each worker process gets
+    its own, workspace-less instance of the processor class with the same
+    parameters. `method` must therefore only depend on its arguments and
+    `self.parameter`, and its arguments and result must be picklable.
+    Anything touching the workspace (e.g. `add_file`) stays in the caller,
+    which consumes the results in deterministic page order. The workers
+    are forked right away, so callers must call this before starting any
+    threads (e.g. before `write_behind`), whose locks the workers would
+    otherwise inherit in whatever state they are in.
+
+    If the method raises an exception for a page, its traceback is printed
+    and a `PageFailure` takes the place of the result, so that one bad page
+    does not abort the others.
+
+    Otherwise, if the processor lists the images of a job with
+    `page_images`, those of the next `prefetch` jobs are decoded on
+    background threads while the current one runs (see `prefetch_pages`).
+    """
+    workers = page_workers(processor.parameter)
+    if workers < 2:
+        return _map_serial(processor, method, jobs)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    pool = multiprocessing.Pool(
+        workers, initializer=_init_worker,
+        initargs=(type(processor), dict(processor.parameter), threads,
+                  timing_enabled()))
+    return _map_pool(pool, method, list(jobs))
@@ -0,0 +1,174 @@
+import threading
+import traceback
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from .timing import span
+from .utils import print_error
+
+__all__ = [
+    'WriteBehind',
+    'write_behind',
+    'PageWrites',
+    'begin_page',
+    'end_page',
+    'submit_write',
+    'prefetch',
+]
+
+
+class WriteBehind(object):
+    """
+    Bounded write-behind queue: the functions submitted run one after the
+    other, in the order submitted, on a background thread, while the
+    caller goes on with the next page. Once `depth` are pending, `submit`
+    blocks until the oldest has finished (back-pressure). The first error
+    of a write is raised again by `close`, after all writes have run.
+    """
+
+    def __init__(self, depth):
+        self.executor = ThreadPoolExecutor(1)
+        self.slots = threading.BoundedSemaphore(depth)
+        self.error = None
+
+    def _run(self, fn, args, kwargs):
+        try:
+            with span('write_behind'):
+                fn(*args, **kwargs)
+        except Exception as err:
+            if self.error is None:
+                self.error = err
+        finally:
+            self.slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        self.executor.submit(self._run, fn, args, kwargs)
+
+    def close(self):
+        """
+        Wait for all pending writes.
+        """
+        self.executor.shutdown()
+        if self.error is not None:
+            raise self.error
+
+
+# the write-behind queue of this process while one is open, otherwise None
+_writer = None
+
+# the page whose writes are being submitted, otherwise None
+_page = None
+
+
+@contextlib.contextmanager
+def write_behind(depth):
+    """
+    Context in which `submit_write` queues writes on a `WriteBehind` of
+    `depth` pending writes (if `depth` is at least 1), all of which are
+    done when the context is left.
+    """
+    global _writer
+    if depth < 1 or _writer is not None:
+        yield
+        return
+    writer = _writer = WriteBehind(depth)
+    try:
+        yield
+    finally:
+        _writer = None
+        writer.close()
+
+
+class PageWrites(object):
+    """
+    The writes submitted for the page `name` between `begin_page` and
+    `end_page`. Once one of them fails, its traceback is printed, the
+    page's remaining writes are skipped and `error` holds the message.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.error = None
+
+
+def begin_page(name):
+    """
+    Submit the following writes as those of the page `name` (see
+    `PageWrites`, which is returned), until `end_page`.
+    """
+    global _page
+    _page = PageWrites(name)
+    return _page
+
+
+def end_page():
+    """
+    Submit the following writes as those of no page: their errors are
+    raised (by the write-behind queue only when it is closed).
+    """
+    global _page
+    _page = None
+
+
+def _write(page, fn, args, kwargs):
+    if page is None:
+        fn(*args, **kwargs)
+        return
+    if page.error is not None:
+        return
+    try:
+        fn(*args, **kwargs)
+    except Exception as err:
+        print_error("writing the output of %s failed, skipping the page:\n%s" % (
+            page.name, traceback.format_exc()))
+        page.error = '%s: %s' % (type(err).__name__, err)
+
+
+def submit_write(fn, *args, **kwargs):
+    """
+    Call `fn(*args, **kwargs)` on the write-behind queue (see `write_behind`), or
+    right away if there is none. `fn` must not depend on state the caller
+    changes afterwards, e.g. on arrays it modifies in place. Between
+    `begin_page` and `end_page`, a failure only fails that page's writes.
+    """
+    if _writer is None:
+        _write(_page, fn, args, kwargs)
+    else:
+        _writer.submit(_write, _page, fn, args, kwargs)
+
+
+def prefetch(jobs, fetch, depth):
+    """
+    Yield `jobs` in order, while the input of the next `depth` jobs is
+    fetched on background threads, so that it is ready when they are
+    processed. `fetch(executor, job)` is called (in the calling thread)
+    for each job before it is yielded, and submits the work of fetching
+    its input to `executor`. At most `depth` jobs beyond the current one
+    are fetched ahead.
+    """
+    if depth < 1:
+        for job in jobs:
+            yield job
+        return
+    jobs = iter(jobs)
+    ahead = collections.deque()
+    executor = ThreadPoolExecutor(depth)
+
+    def fill():
+        while len(ahead) <= depth:
+            job = next(jobs, None)
+            if job is None:
+                return
+            fetch(executor, job)
+            ahead.append(job)
+
+    try:
+        while True:
+            fill()
+            if not ahead:
+                return
+            yield ahead.popleft()
+    finally:
+        executor.shutdown(wait=False)
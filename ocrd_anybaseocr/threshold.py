@@ -0,0 +1,97 @@
+import numpy as np
+import cv2
+
+__all__ = [
+    'StreamingHistogram',
+    'variance_mask',
+    'estimate_thresholds',
+]
+
+
+class StreamingHistogram(object):
+    """
+    Fixed-bin histogram of values in [low, high], accumulated chunk by
+    chunk, for percentiles of data that is never held in memory at once.
+    """
+
+    def __init__(self, bins=4096, low=0.0, high=1.0):
+        self.bins = bins
+        self.low = float(low)
+        # OpenCV excludes the upper range limit, widen it so that `high`
+        # still falls into the last bin
+        self.top = float(high) + max(float(high) - self.low, 1.0) * 1e-6
+        self.counts = np.zeros(bins, np.int64)
+
+    def add(self, values, mask=None):
+        """
+        Count `values` (an array of any shape), only where the boolean
+        array `mask` is set if given. Selected values are not copied.
+        """
+        values = np.asarray(values)
+        if values.dtype not in (np.uint8, np.uint16, np.float32):
+            values = values.astype(np.float32)
+        if values.ndim != 2:
+            values = values.reshape(-1, 1)
+            if mask is not None:
+                mask = mask.reshape(-1, 1)
+        if mask is not None:
+            mask = mask.view(np.uint8)
+        hist = cv2.calcHist([values], [0], mask, [self.bins], [self.low, self.top])
+        self.counts += np.rint(hist.ravel()).astype(np.int64)
+
+    def percentile(self, perc):
+        """
+        Value at percentile `perc` (0..100) of everything added, like
+        `scipy.stats.scoreatpercentile` on the raw values, up to the bin
+        width.
+        """
+        n = self.counts.sum()
+        if n == 0:
+            return np.nan
+        # position in the sorted values, interpolated within its bin
+        target = (n - 1) * perc / 100.0
+        cum = np.cumsum(self.counts)
+        i = min(int(np.searchsorted(cum, target, side='right')), self.bins - 1)
+        within = (target - (cum[i] - self.counts[i]) + 0.5) / max(self.counts[i], 1)
+        return self.low + (i + min(within, 1.0)) / self.bins * (self.top - self.low)
+
+
+def variance_mask(est, escale):
+    """
+    Regions of `est` with significant local variance, at scale `escale`.
+    """
+    from scipy.ndimage import filters, morphology
+
+    e = escale
+    v = est-filters.gaussian_filter(est, e*20.0)
+    v = filters.gaussian_filter(v**2, e*20.0)**0.5
+    v = (v > 0.3*np.amax(v))
+    v = morphology.binary_dilation(
+        v, structure=np.ones((int(e*50), 1)))
+    v = morphology.binary_dilation(
+        v, structure=np.ones((1, int(e*50))))
+    return v
+
+
+def estimate_thresholds(flat, bignore, escale, lo, hi, bins=4096, show=None):
+    """
+    Estimate the black and white levels of the grayscale image `flat` as
+    its `lo` and `hi` percentiles, ignoring a `bignore` fraction of each
+    border. For `escale` > 0, only regions that contain significant
+    variance are used, which makes the estimates more reliable.
+
+    Both percentiles are read from one `bins`-bin histogram over the
+    (masked) region, so nothing is sorted or copied. `show` is called
+    with the variance mask, for debugging.
+    """
+    d0, d1 = flat.shape
+    o0, o1 = int(bignore*d0), int(bignore*d1)
+    est = flat[o0:d0-o0, o1:d1-o1]
+    mask = None
+    if escale > 0:
+        mask = variance_mask(est, escale)
+        if show is not None:
+            show(mask)
+    hist = StreamingHistogram(bins, np.amin(est), np.amax(est))
+    hist.add(est, mask)
+    return hist.percentile(lo), hist.percentile(hi)
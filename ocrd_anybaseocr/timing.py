@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import cProfile
+import contextlib
+import fnmatch
+
+from .utils import print_info
+
+__all__ = [
+    'TIMING_ENV',
+    'PROFILE_ENV',
+    'PROFILE_PAGES_ENV',
+    'Histogram',
+    'timing_enabled',
+    'enable_timing',
+    'span',
+    'take_timings',
+    'merge_timings',
+    'report_timings',
+    'profile_page',
+]
+
+# environment variables: timing on ('1', or a JSON file for the report),
+# a directory for cProfile dumps of pages, and the glob patterns of the
+# image file names of the pages to profile (default: all)
+TIMING_ENV = 'OCRD_ANYBASEOCR_TIMING'
+PROFILE_ENV = 'OCRD_ANYBASEOCR_PROFILE'
+PROFILE_PAGES_ENV = 'OCRD_ANYBASEOCR_PROFILE_PAGES'
+
+# histogram buckets are powers of two of microseconds, up to ~36 minutes
+BUCKETS = 32
+
+
+class Histogram(object):
+    """
+    Durations of a span: count, total, minimum and maximum, and a
+    histogram with power-of-two buckets (1 us, 2 us, 4 us, ...) from
+    which percentiles are read.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[min(bucket, BUCKETS - 1)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for (a, b) in zip(self.buckets, other.buckets)]
+
+    def percentile(self, perc):
+        """
+        Upper bound of the bucket holding percentile `perc` (0..100),
+        capped at the maximum.
+        """
+        target = self.count * perc / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': self.buckets,
+        }
+
+
+# histograms by span name while timing is enabled, otherwise None
+_timings = {} if os.environ.get(TIMING_ENV, '') not in ('', '0') else None
+
+
+def timing_enabled():
+    return _timings is not None
+
+
+def enable_timing(enabled=True):
+    """
+    Switch timing on (keeping what was recorded so far) or off.
+    """
+    global _timings
+    if not enabled:
+        _timings = None
+    elif _timings is None:
+        _timings = {}
+
+
+class _Span(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        if _timings is not None:
+            if self.name not in _timings:
+                _timings[self.name] = Histogram()
+            _timings[self.name].add(seconds)
+        return False
+
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name):
+    """
+    Context manager timing the enclosed code as span `name`, if timing is
+    enabled (see $OCRD_ANYBASEOCR_TIMING). Otherwise it does nothing.
+    """
+    if _timings is None:
+        return _NO_SPAN
+    return _Span(name)
+
+
+def take_timings():
+    """
+    The histograms recorded so far (by span name), which are cleared.
+    """
+    global _timings
+    if _timings is None:
+        return {}
+    taken, _timings = _timings, {}
+    return taken
+
+
+def merge_timings(timings):
+    """
+    Add the histograms `timings` (e.g. taken in a worker process).
+    """
+    if _timings is None:
+        return
+    for name, histogram in timings.items():
+        if name in _timings:
+            _timings[name].merge(histogram)
+        else:
+            _timings[name] = histogram
+
+
+def report_timings():
+    """
+    Print the spans recorded so far, by total time, and write them as JSON
+    if $OCRD_ANYBASEOCR_TIMING names a file.
+    """
+    if not _timings:
+        return
+    report = dict((name, histogram.as_dict()) for (name, histogram) in _timings.items())
+    print_info("%-16s %7s %10s %9s %9s %9s %9s" % (
+        'span', 'count', 'total', 'mean', 'p50', 'p90', 'max'))
+    for name, stats in sorted(report.items(), key=lambda item: -item[1]['total']):
+        print_info("%-16s %7d %9.3fs %8.4fs %8.4fs %8.4fs %8.4fs" % (
+            name, stats['count'], stats['total'], stats['mean'],
+            stats['p50'], stats['p90'], stats['max']))
+    path = os.environ.get(TIMING_ENV, '')
+    if path not in ('', '0', '1'):
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+@contextlib.contextmanager
+def profile_page(fname, method):
+    """
+    Run the enclosed page method `method` for the image `fname` under
+    cProfile, if $OCRD_ANYBASEOCR_PROFILE names a directory and the file
+    name matches $OCRD_ANYBASEOCR_PROFILE_PAGES. The statistics go to
+    `<directory>/<file name>.<method>.prof` (for pstats, snakeviz, or
+    flameprof for a flame graph).
+    """
+    directory = os.environ.get(PROFILE_ENV)
+    name = os.path.basename(str(fname))
+    patterns = (os.environ.get(PROFILE_PAGES_ENV) or '*').split(',')
+    if not directory or fname is None or not any(
+            fnmatch.fnmatch(name, pattern) for pattern in patterns):
+        yield
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(os.path.join(directory, '%s.%s.prof' % (name, method)))
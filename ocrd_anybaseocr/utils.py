@@ -1,15 +1,24 @@
+import os
 import os.path
+import re
 import sys
-from xml.dom import minidom
-import ocrolib
+import tempfile
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
 
 __all__ = [
     'print_error',
     'print_info',
+    'allsplitext',
+    'iter_mets_files',
+    'append_mets_file_grp',
     'parseXML',
     'write_to_xml',
 ]
 
+METS_NS = 'http://www.loc.gov/METS/'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+
 
 def parse_params_with_defaults(params_json, params_schema):
     """
@@ -22,46 +31,215 @@ def parse_params_with_defaults(params_json, params_schema):
     return params_json
 
 
+def iter_mets_files(fpath, Input):
+    """
+    Yield the `xlink:href` of each `mets:FLocat` in the `mets:fileGrp`s
+    with USE `Input` of the METS file `fpath`, in document order.
+
+    The METS is parsed incrementally and every element is dropped once
+    it has been parsed, so memory stays bounded however many files the
+    METS has.
+    """
+    file_grp = '{%s}fileGrp' % METS_NS
+    flocat = '{%s}FLocat' % METS_NS
+    href = '{%s}href' % XLINK_NS
+    parents = []
+    in_group = False
+    for event, elem in ET.iterparse(fpath, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == file_grp:
+                in_group = elem.get('USE') == Input
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag == flocat and in_group:
+            yield elem.get(href)
+        elif elem.tag == file_grp:
+            in_group = False
+        if parents:
+            parents[-1].remove(elem)
+
+
 def parseXML(fpath, Input):
-    input_files = []
-    xmldoc = minidom.parse(fpath)
-    nodes = xmldoc.getElementsByTagName('mets:fileGrp')
-    for attr in nodes:
-        if attr.attributes['USE'].value == Input:
-            childNodes = attr.getElementsByTagName('mets:FLocat')
-            for f in childNodes:
-                input_files.append(f.attributes['xlink:href'].value)
-    return input_files
+    return list(iter_mets_files(fpath, Input))
 
 
-def write_to_xml(fpath, mets, Output, OutputMets, work):
-    xmldoc = minidom.parse(mets)
-    subRoot = xmldoc.createElement('mets:fileGrp')
-    subRoot.setAttribute('USE', Output)
+class _FileSecFound(Exception):
+    pass
+
+
+def _locate_file_sec(mets):
+    """
+    Parse the METS file `mets` up to the end tag of its `mets:fileSec`
+    and return the byte offsets of that end tag and of the start tag of
+    the fileSec's last `mets:fileGrp` (or None), and the prefixes bound
+    to the METS and XLink namespaces there (None if unbound).
+    """
+    from xml.parsers import expat
+
+    parser = expat.ParserCreate(namespace_separator=' ')
+    parser.namespace_prefixes = True
+    file_sec = METS_NS + ' fileSec'
+    file_grp = METS_NS + ' fileGrp'
+    # namespace bindings in scope, innermost last
+    bindings = []
+    found = {'depth': 0, 'group': None}
+
+    def prefix(uri):
+        for (bound, bound_uri) in reversed(bindings):
+            if bound_uri == uri:
+                return bound or ''
+        return None
+
+    def start_namespace(bound, uri):
+        bindings.append((bound, uri))
+
+    def end_namespace(bound):
+        for i in range(len(bindings) - 1, -1, -1):
+            if bindings[i][0] == bound:
+                del bindings[i]
+                break
+
+    def start(name, attrs):
+        name = ' '.join(name.split(' ')[:2])
+        if name == file_sec:
+            found['depth'] = 1
+        elif found['depth']:
+            found['depth'] += 1
+            if found['depth'] == 2 and name == file_grp:
+                found['group'] = parser.CurrentByteIndex
+
+    def end(name):
+        if ' '.join(name.split(' ')[:2]) == file_sec:
+            found.update(end=parser.CurrentByteIndex,
+                         mets=prefix(METS_NS), xlink=prefix(XLINK_NS))
+            raise _FileSecFound()
+        if found['depth']:
+            found['depth'] -= 1
 
-    for f in fpath:
-        basefile = ocrolib.allsplitext(os.path.basename(f))[0]
-        child = xmldoc.createElement('mets:file')
-        child.setAttribute('ID', 'CROP_'+basefile)
-        child.setAttribute('GROUPID', 'P_' + basefile)
-        child.setAttribute('MIMETYPE', "image/png")
+    parser.StartNamespaceDeclHandler = start_namespace
+    parser.EndNamespaceDeclHandler = end_namespace
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    with open(mets, 'rb') as f:
+        try:
+            parser.ParseFile(f)
+        except _FileSecFound:
+            return found['end'], found['group'], found['mets'], found['xlink']
+    raise ValueError("%s has no mets:fileSec (in namespace %s)" % (mets, METS_NS))
 
-        subChild = xmldoc.createElement('mets:FLocat')
-        subChild.setAttribute('LOCTYPE', "URL")
-        subChild.setAttribute('xlink:href', f)
 
-        subRoot.appendChild(child)
-        child.appendChild(subChild)
+def _indentation(f, offset):
+    # the whitespace between the last line break before `offset` and it,
+    # or None if the line has anything else there
+    f.seek(max(0, offset - 256))
+    line = f.read(offset - max(0, offset - 256)).rsplit(b'\n', 1)
+    if len(line) < 2 or line[1].strip(b' \t'):
+        return None
+    return line[1]
 
-    xmldoc.getElementsByTagName('mets:fileSec')[0].appendChild(subRoot)
 
+def append_mets_file_grp(mets, output, Output, files, chunk=1 << 20):
+    """
+    Copy the METS file `mets` to `output` (which may be `mets` itself),
+    adding a `mets:fileGrp` with USE `Output` at the end of its
+    `mets:fileSec`, with a `mets:file` for each `(ID, GROUPID, MIMETYPE,
+    href)` of `files`.
+
+    The fileSec is found by its namespace, whatever prefix the METS binds
+    to it, and the new group uses the same prefixes and the indentation
+    of its siblings. The METS is copied verbatim in chunks of `chunk`
+    bytes around it, and `files` may be an iterator, so memory stays
+    bounded however large the METS or the new group are. The result is
+    written to a temporary file which then replaces `output`.
+    """
+    end, group, mets_prefix, xlink_prefix = _locate_file_sec(mets)
+    # no prefix if the fileSec is in the default namespace
+    mets_tag = mets_prefix + ':' if mets_prefix else ''
+    end_tag = ('</%sfileSec' % mets_tag).encode('utf-8')
+    with open(mets, 'rb') as src:
+        src.seek(end)
+        if src.read(len(end_tag)) != end_tag:
+            raise ValueError("%s has an empty mets:fileSec" % mets)
+        closing = _indentation(src, end)
+        inner = _indentation(src, group) if group is not None else None
+        src.seek(max(0, end - len(closing or b'') - 2))
+        crlf = src.read(2) == b'\r\n'
+    if closing is None:
+        # not pretty-printed: no line breaks either
+        closing = inner = b''
+        newline = ''
+        insert = end
+    else:
+        if inner is None or len(inner) <= len(closing):
+            inner = closing + b'  '
+        newline = '\r\n' if crlf else '\n'
+        # insert before the line break and indentation of the end tag
+        insert = end - len(closing) - len(newline)
+    step = (inner[len(closing):] if inner.startswith(closing) else b'  ').decode('utf-8')
+    indent = [inner.decode('utf-8') + step * level for level in range(3)] if newline else [''] * 3
+    if xlink_prefix:
+        href_attr = xlink_prefix + ':href'
+        xmlns = ''
+    else:
+        href_attr = 'xlink:href'
+        xmlns = ' xmlns:xlink=%s' % quoteattr(XLINK_NS)
+
+    directory = os.path.dirname(os.path.abspath(output))
+    fd, tmp = tempfile.mkstemp(prefix='.mets', suffix='.xml', dir=directory)
+    try:
+        with open(mets, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            remaining = insert
+            while remaining:
+                block = src.read(min(chunk, remaining))
+                dst.write(block)
+                remaining -= len(block)
+            dst.write(('%s%s<%sfileGrp USE=%s%s>' % (
+                newline, indent[0], mets_tag, quoteattr(Output), xmlns)).encode('utf-8'))
+            for (ID, GROUPID, MIMETYPE, href) in files:
+                dst.write((
+                    '%s%s<%sfile ID=%s GROUPID=%s MIMETYPE=%s>'
+                    '%s%s<%sFLocat LOCTYPE="URL" %s=%s/>'
+                    '%s%s</%sfile>' % (
+                        newline, indent[1], mets_tag,
+                        quoteattr(ID), quoteattr(GROUPID), quoteattr(MIMETYPE),
+                        newline, indent[2], mets_tag, href_attr, quoteattr(href),
+                        newline, indent[1], mets_tag)).encode('utf-8'))
+            dst.write(('%s%s</%sfileGrp>' % (newline, indent[0], mets_tag)).encode('utf-8'))
+            for block in iter(lambda: src.read(chunk), b''):
+                dst.write(block)
+        os.chmod(tmp, os.stat(mets).st_mode & 0o777)
+        os.replace(tmp, output)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def allsplitext(path):
+    """
+    Split `path` at the first dot of its base name, like
+    `ocrolib.allsplitext`, without importing ocrolib.
+    """
+    match = re.search(r'((.*/)*[^.]*)([^/]*)', path)
+    if not match:
+        return path, ""
+    return match.group(1), match.group(3)
+
+
+def write_to_xml(fpath, mets, Output, OutputMets, work):
     if not OutputMets:
-        metsFileSave = open(os.path.join(
-            work, os.path.basename(mets)), "w")
+        output = os.path.join(work, os.path.basename(mets))
     else:
-        metsFileSave = open(os.path.join(work, OutputMets if OutputMets.endswith(
-            ".xml") else OutputMets+'.xml'), "w")
-    metsFileSave.write(xmldoc.toxml())
+        output = os.path.join(work, OutputMets if OutputMets.endswith(
+            ".xml") else OutputMets+'.xml')
+
+    def files():
+        for f in fpath:
+            basefile = allsplitext(os.path.basename(f))[0]
+            yield 'CROP_'+basefile, 'P_' + basefile, "image/png", f
+
+    append_mets_file_grp(mets, output, Output, files())
+
 
 def print_info(msg):
     print("INFO: %s" % msg)